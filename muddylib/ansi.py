@@ -0,0 +1,197 @@
+import re
+
+
+# Parameter bytes (private ones like '?' included), intermediate bytes, final byte
+CSI_RX = re.compile('\x1b\\[([0-?]*)([ -/]*)([@-~])')
+
+SGR_PARAMS_RX = re.compile('[0-9;:]*')
+
+# A style packs foreground and background color and the text attributes
+# into one int: bits 0-8 hold foreground color + 1 (0 being the terminal
+# default), bits 9-17 the background the same way, and the flags follow.
+DEFAULT = 0
+
+COLOR_BITS = 9
+COLOR_MASK = (1 << COLOR_BITS) - 1
+
+BOLD = 1 << 18
+UNDERLINE = 1 << 19
+REVERSE = 1 << 20
+
+CUBE_STEPS = (0, 95, 135, 175, 215, 255)
+
+
+def fg_of(style):
+    return (style & COLOR_MASK) - 1
+
+
+def bg_of(style):
+    return ((style >> COLOR_BITS) & COLOR_MASK) - 1
+
+
+def with_fg(style, color):
+    return (style & ~COLOR_MASK) | (color + 1)
+
+
+def with_bg(style, color):
+    return (style & ~(COLOR_MASK << COLOR_BITS)) | ((color + 1) << COLOR_BITS)
+
+
+def rgb_to_256(r, g, b):
+    def step(v):
+        return min(range(6), key=lambda i: abs(CUBE_STEPS[i] - v))
+
+    return 16 + 36 * step(r) + 6 * step(g) + step(b)
+
+
+def apply_sgr(style, params):
+    codes = [int(c) if c else 0 for c in params.replace(':', ';').split(';')]
+
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+
+        if code == 0:
+            style = DEFAULT
+        elif code == 1:
+            style |= BOLD
+        elif code == 22:
+            style &= ~BOLD
+        elif code == 4:
+            style |= UNDERLINE
+        elif code == 24:
+            style &= ~UNDERLINE
+        elif code == 7:
+            style |= REVERSE
+        elif code == 27:
+            style &= ~REVERSE
+        elif 30 <= code <= 37:
+            style = with_fg(style, code - 30)
+        elif code == 39:
+            style = with_fg(style, -1)
+        elif 40 <= code <= 47:
+            style = with_bg(style, code - 40)
+        elif code == 49:
+            style = with_bg(style, -1)
+        elif 90 <= code <= 97:
+            style = with_fg(style, code - 90 + 8)
+        elif 100 <= code <= 107:
+            style = with_bg(style, code - 100 + 8)
+        elif code in (38, 48) and i + 1 < len(codes):
+            setter = with_fg if code == 38 else with_bg
+            if codes[i + 1] == 5 and i + 2 < len(codes):
+                style = setter(style, codes[i + 2] & 0xff)
+                i += 2
+            elif codes[i + 1] == 2 and i + 4 < len(codes):
+                style = setter(style, rgb_to_256(*codes[i + 2:i + 5]))
+                i += 4
+
+        i += 1
+
+    return style
+
+
+def parse(text, style=DEFAULT):
+    """
+    Splits a line with ANSI escapes into an immutable tuple of
+    (text, style) runs. Only SGR sequences affect the style, other
+    control sequences are dropped.
+    """
+    if '\x1b' not in text:
+        return ((text, style),) if text else ()
+
+    runs = []
+    pos = 0
+    for m in CSI_RX.finditer(text):
+        if m.start() > pos:
+            runs.append((text[pos:m.start()], style))
+        if m.group(3) == 'm' and not m.group(2) and SGR_PARAMS_RX.fullmatch(m.group(1)):
+            style = apply_sgr(style, m.group(1))
+        pos = m.end()
+
+    if pos < len(text):
+        runs.append((text[pos:], style))
+
+    return tuple(merge_runs(runs))
+
+
+def merge_runs(runs):
+    merged = []
+    for text, style in runs:
+        if merged and merged[-1][1] == style:
+            merged[-1] = (merged[-1][0] + text, style)
+        elif text:
+            merged.append((text, style))
+
+    return merged
+
+
+def highlight(runs, spans, flags=REVERSE):
+    """Sets flags on the parts of runs covered by spans, ascending (start, end) character offsets."""
+    result = []
+    pos = 0
+    for text, style in runs:
+        end = pos + len(text)
+        cut = pos
+        for start, stop in spans:
+            if stop <= cut or start >= end:
+                continue
+
+            start = max(start, cut)
+            stop = min(stop, end)
+            if start > cut:
+                result.append((text[cut - pos:start - pos], style))
+            result.append((text[start - pos:stop - pos], style | flags))
+            cut = stop
+
+        if cut < end:
+            result.append((text[cut - pos:], style))
+        pos = end
+
+    return tuple(result)
+
+
+def slice_runs(runs, start, end):
+    """The part of runs between the character offsets start and end."""
+    result = []
+    pos = 0
+    for text, style in runs:
+        stop = pos + len(text)
+        if stop > start and pos < end:
+            result.append((text[max(start - pos, 0):end - pos], style))
+        pos = stop
+        if pos >= end:
+            break
+
+    return tuple(result)
+
+
+def strip(text):
+    if '\x1b' not in text:
+        return text
+
+    return CSI_RX.sub('', text)
+
+
+def plain_text(runs):
+    return ''.join(text for text, style in runs)
+
+
+def downsample(color, colors):
+    """Maps a 256-color palette index onto a terminal supporting fewer colors."""
+    if color < 0 or color < colors:
+        return color
+
+    if color >= 232:
+        level = color - 232
+        color = 0 if level < 6 else 8 if level < 12 else 7 if level < 18 else 15
+    elif color >= 16:
+        r, g, b = (color - 16) // 36, (color - 16) // 6 % 6, (color - 16) % 6
+        color = (r >= 3) + 2 * (g >= 3) + 4 * (b >= 3)
+        if max(r, g, b) >= 4:
+            color += 8
+
+    if color >= colors:
+        color &= 7
+
+    return color
@@ -0,0 +1,222 @@
+import collections
+import fcntl
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+
+
+# Text bytes after which the archive moves on to a new segment
+SEGMENT_BYTES = 64 << 20
+
+# Lines loaded back into memory when a scrollback is reopened
+DEFAULT_RESTORE_LINES = 1000
+
+# Seconds between flushes of the segment being written, bounding what a
+# crash can lose
+FLUSH_INTERVAL = 1.0
+
+# Segments kept mapped at once; the others are unmapped until looked at
+MAPPED_SEGMENTS = 8
+
+# Per line: end offset in the text file, end offset in the runs file and
+# the display width as stored by ScrollbackBuffer
+INDEX_RECORD = struct.Struct('<QQQ')
+
+SEGMENT_FILES = ('txt', 'runs', 'idx')
+
+LOCK_FILE = 'lock'
+
+
+class ArchiveInUse(Exception):
+    pass
+
+
+class Segment:
+    """
+    Files of consecutive lines, named after the number of the first one:
+    the text (each line followed by a newline), the packed runs and an
+    index of where every line ends. The index is written last, so after a
+    crash whatever it doesn't cover is cut off on reopening.
+    """
+
+    def __init__(self, directory, first_line):
+        self.first_line = first_line
+        base = os.path.join(directory, f'{first_line:012d}')
+        self.paths = {kind: f'{base}.{kind}' for kind in SEGMENT_FILES}
+
+        self.line_count = 0
+        self.text_size = 0
+        self.runs_size = 0
+        self.files = None
+        self._maps = None
+        self._mapped_lines = 0
+
+    def open(self, append=False):
+        sizes = {kind: os.path.getsize(path) if os.path.exists(path) else 0 for kind, path in self.paths.items()}
+        self.line_count = sizes['idx'] // INDEX_RECORD.size
+        self.text_size, self.runs_size = 0, 0
+
+        # Only the last valid record is needed; records of lines whose data
+        # never made it to disk are dropped, walking back from the end
+        if self.line_count:
+            with open(self.paths['idx'], 'rb') as f:
+                while self.line_count:
+                    f.seek((self.line_count - 1) * INDEX_RECORD.size)
+                    text_end, runs_end, width = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+                    if text_end <= sizes['txt'] and runs_end <= sizes['runs']:
+                        self.text_size, self.runs_size = text_end, runs_end
+                        break
+                    self.line_count -= 1
+
+        if append:
+            self.files = {kind: open(path, 'ab') for kind, path in self.paths.items()}
+            self.files['idx'].truncate(self.line_count * INDEX_RECORD.size)
+            self.files['txt'].truncate(self.text_size)
+            self.files['runs'].truncate(self.runs_size)
+
+    def append(self, data, runs, width):
+        self.files['txt'].write(data)
+        self.files['txt'].write(b'\n')
+        self.files['runs'].write(runs)
+        self.text_size += len(data) + 1
+        self.runs_size += len(runs)
+        self.files['idx'].write(INDEX_RECORD.pack(self.text_size, self.runs_size, width))
+        self.line_count += 1
+
+    def flush(self):
+        if self.files:
+            for kind in SEGMENT_FILES:
+                self.files[kind].flush()
+
+    def close(self):
+        self.unmap()
+        if self.files:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+    def line(self, i):
+        """(text, packed runs, width) of the i-th line of the segment."""
+        maps = self._mapped(i)
+        index = maps['idx']
+        if i:
+            text_start, runs_start, width = INDEX_RECORD.unpack_from(index, (i - 1) * INDEX_RECORD.size)
+        else:
+            text_start, runs_start = 0, 0
+        text_end, runs_end, width = INDEX_RECORD.unpack_from(index, i * INDEX_RECORD.size)
+
+        runs = array('Q')
+        runs.frombytes(maps['runs'][runs_start:runs_end])
+        return maps['txt'][text_start:text_end - 1].decode('utf-8'), runs, width
+
+    def unmap(self):
+        if self._maps:
+            for m in self._maps.values():
+                if isinstance(m, mmap.mmap):
+                    m.close()
+        self._maps = None
+
+    def _mapped(self, i):
+        # The segment being appended to is mapped again once it has grown
+        # past what the current mapping covers
+        if self._maps is None or i >= self._mapped_lines:
+            self.flush()
+            self.unmap()
+            self._maps = {kind: self._map(path) for kind, path in self.paths.items()}
+            self._mapped_lines = self.line_count
+
+        return self._maps
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ScrollbackArchive:
+    """
+    Unbounded on-disk history of a scrollback, in append-only segments
+    that are read through mmap, so that lines cost no memory until they
+    are looked at. Line numbers carry on across restarts. Only one
+    process at a time may have a directory open; another one gets
+    ArchiveInUse.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = open(os.path.join(directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            raise ArchiveInUse(f'{directory} is in use by another process')
+
+        firsts = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx'))
+        self.segments = [Segment(directory, first) for first in firsts]
+        for segment in self.segments[:-1]:
+            segment.open()
+
+        if self.segments:
+            self.segments[-1].open(append=True)
+        else:
+            self._new_segment(0)
+
+        self._starts = [segment.first_line for segment in self.segments]
+        self._mapped = collections.OrderedDict()
+
+    @property
+    def start(self):
+        return self.segments[0].first_line
+
+    @property
+    def line_count(self):
+        """Number of the line the next append() gets."""
+        last = self.segments[-1]
+        return last.first_line + last.line_count
+
+    def append(self, data, runs, width):
+        """Adds a line as UTF-8 text, packed runs (bytes) and display width."""
+        last = self.segments[-1]
+        if last.text_size >= self.segment_bytes:
+            last.close()
+            last.open()
+            last = self._new_segment(self.line_count)
+            self._starts.append(last.first_line)
+
+        last.append(data, runs, width)
+
+    def line(self, line_number):
+        if not self.start <= line_number < self.line_count:
+            raise IndexError('archive line out of range')
+
+        segment = self.segments[bisect_right(self._starts, line_number) - 1]
+
+        self._mapped.pop(segment.first_line, None)
+        self._mapped[segment.first_line] = segment
+        if len(self._mapped) > MAPPED_SEGMENTS:
+            first, oldest = self._mapped.popitem(last=False)
+            oldest.unmap()
+
+        return segment.line(line_number - segment.first_line)
+
+    def flush(self):
+        self.segments[-1].flush()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        # Closing the file releases the lock
+        self._lock.close()
+
+    def _new_segment(self, first_line):
+        segment = Segment(self.directory, first_line)
+        segment.open(append=True)
+        self.segments.append(segment)
+        return segment
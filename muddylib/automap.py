@@ -0,0 +1,195 @@
+import collections
+import os
+import sqlite3
+
+from twisted.internet import threads
+
+
+DEFAULT_DATABASE = '~/.muddy/automap.db'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS rooms ('
+    ' id INTEGER PRIMARY KEY, name TEXT NOT NULL, area TEXT, terrain TEXT,'
+    ' x INTEGER, y INTEGER, cont INTEGER)',
+    'CREATE INDEX IF NOT EXISTS rooms_name ON rooms (name COLLATE NOCASE)',
+    'CREATE INDEX IF NOT EXISTS rooms_area ON rooms (area)',
+    'CREATE TABLE IF NOT EXISTS exits ('
+    ' room INTEGER NOT NULL, direction TEXT NOT NULL, target INTEGER NOT NULL,'
+    ' PRIMARY KEY (room, direction)) WITHOUT ROWID',
+)
+
+
+def read_adjacency(db):
+    adjacency = {}
+    for room, direction, target in db.execute('SELECT room, direction, target FROM exits ORDER BY room, direction'):
+        adjacency.setdefault(room, []).append((direction, target))
+
+    return {room: tuple(exits) for room, exits in adjacency.items()}
+
+
+def read_adjacency_file(path):
+    db = sqlite3.connect(path)
+    try:
+        return read_adjacency(db)
+    finally:
+        db.close()
+
+
+class Room:
+    __slots__ = ('id', 'name', 'area', 'terrain', 'x', 'y', 'cont', 'exits')
+
+    def __init__(self, id, name, area=None, terrain=None, x=None, y=None, cont=None, exits=None):
+        self.id = id
+        self.name = name
+        self.area = area
+        self.terrain = terrain
+        self.x = x
+        self.y = y
+        self.cont = cont
+        self.exits = exits or {}
+
+
+class RoomGraph:
+    """
+    The rooms seen so far, kept in SQLite. Path queries run over an
+    in-memory adjacency map of room id -> ((direction, target), ...),
+    read from the database on a thread by warm(), or on the first query
+    if that has not finished yet, and kept up to date by add_room() from
+    then on, so opening the map costs nothing up front.
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+        self._adjacency = None
+        self._warming = None
+        # Rooms added while warm() reads the adjacency map, which may be
+        # after its connection looked
+        self._added = None
+
+    def add_room(self, room):
+        """Stores a room and its exits; returns whether anything about it changed."""
+        row = (room.id, room.name, room.area, room.terrain, room.x, room.y, room.cont)
+        exits = tuple(sorted(room.exits.items()))
+        if self.db.execute('SELECT * FROM rooms WHERE id = ?', (room.id,)).fetchone() == row and \
+                tuple(self.db.execute('SELECT direction, target FROM exits WHERE room = ? ORDER BY direction',
+                                      (room.id,))) == exits:
+            return False
+
+        self.db.execute('INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+        self.db.execute('DELETE FROM exits WHERE room = ?', (room.id,))
+        self.db.executemany('INSERT INTO exits VALUES (?, ?, ?)',
+                            [(room.id, direction, target) for direction, target in exits])
+
+        if self._adjacency is not None:
+            self._adjacency[room.id] = exits
+        elif self._added is not None:
+            self._added[room.id] = exits
+        return True
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def room(self, room_id):
+        row = self.db.execute('SELECT * FROM rooms WHERE id = ?', (room_id,)).fetchone()
+        if row is None:
+            return None
+
+        return Room(*row, exits=dict(self.db.execute('SELECT direction, target FROM exits WHERE room = ?', (room_id,))))
+
+    def named(self, name):
+        return [row[0] for row in self.db.execute('SELECT id FROM rooms WHERE name = ? COLLATE NOCASE', (name,))]
+
+    def find(self, query):
+        """Ids of the rooms query names: a room id, a room name, a room name prefix or an area, first that matches."""
+        if query.isdigit():
+            return [int(query)]
+
+        ids = self.named(query)
+        if ids:
+            return ids
+
+        prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        for sql, argument in (
+                ('SELECT id FROM rooms WHERE area = ?', query),
+                ("SELECT id FROM rooms WHERE name LIKE ? ESCAPE '\\'", prefix)):
+            ids = [row[0] for row in self.db.execute(sql, (argument,))]
+            if ids:
+                return ids
+
+        return []
+
+    def warm(self):
+        """Reads the adjacency map on a thread, so that the first path query finds it ready."""
+        if self._adjacency is None and self._warming is None:
+            # Its own connection only sees what has been committed
+            self.db.commit()
+            self._added = {}
+            self._warming = threads.deferToThread(read_adjacency_file, self.path)
+            self._warming.addCallbacks(self._warmed, self._warm_failed)
+
+        return self._warming
+
+    def _warmed(self, adjacency):
+        self._warming = None
+        if self._adjacency is None:
+            adjacency.update(self._added)
+            self._adjacency = adjacency
+        self._added = None
+
+    def _warm_failed(self, failure):
+        # The first path query reads it instead
+        self._warming = None
+        self._added = None
+
+    def adjacency(self):
+        if self._adjacency is None:
+            self._adjacency = read_adjacency(self.db)
+
+        return self._adjacency
+
+    def shortest_path(self, start, targets):
+        """
+        Directions of a shortest path from start to the nearest of targets,
+        or None if none is reachable. Every move costs the same, so a
+        breadth-first search finds it.
+        """
+        targets = set(targets)
+        if start in targets:
+            return []
+
+        adjacency = self.adjacency()
+        previous = {start: None}
+        queue = collections.deque([start])
+        while queue:
+            room = queue.popleft()
+            for direction, target in adjacency.get(room, ()):
+                if target in previous:
+                    continue
+
+                previous[target] = (room, direction)
+                if target in targets:
+                    path = []
+                    while target != start:
+                        target, step = previous[target]
+                        path.append(step)
+                    return path[::-1]
+
+                queue.append(target)
+
+        return None
@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import pty
+import resource
+import sys
+import tempfile
+import time
+
+from muddylib.headless import HeadlessScreen
+from muddylib.metrics import Metrics
+from muddylib.telnet import read_capture
+
+
+def run_benchmark(capture_path, screen=None):
+    from muddylib.replay import ReplaySession
+
+    capture = list(read_capture(capture_path))
+
+    session = ReplaySession(screen or HeadlessScreen(), headless=screen is None)
+    handler_metrics = Metrics()
+    session.plugin_manager.wrap_handlers(handler_metrics.wrap_handler)
+
+    started = time.perf_counter()
+    session.replay(capture)
+    elapsed = time.perf_counter() - started
+
+    scheduler = session.mud_screen.render_scheduler
+
+    return {
+        'capture': capture_path,
+        'terminal': 'headless' if screen is None else 'pty',
+        'bytes': session.bytes,
+        'lines': session.lines,
+        'seconds': elapsed,
+        'lines_per_second': session.lines / elapsed if elapsed else 0.0,
+        'bytes_per_second': session.bytes / elapsed if elapsed else 0.0,
+        'handlers': {name: stats.as_dict() for name, stats in sorted(handler_metrics.handlers.items())},
+        'frames': scheduler.frames,
+        'render_seconds': scheduler.render_seconds,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_in_pty(capture_path, columns=160, lines=50):
+    """Replays against real curses inside a pseudo-terminal whose output is drained and counted."""
+    report_fd, report_path = tempfile.mkstemp(suffix='.json')
+    os.close(report_fd)
+
+    pid, master = pty.fork()
+    if pid == 0:
+        import curses
+
+        os.environ['LINES'] = str(lines)
+        os.environ['COLUMNS'] = str(columns)
+
+        def child(screen):
+            return run_benchmark(capture_path, screen)
+
+        report = curses.wrapper(child)
+        with open(report_path, 'w') as f:
+            json.dump(report, f)
+        os._exit(0)
+
+    terminal_bytes = 0
+    while True:
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        terminal_bytes += len(data)
+
+    os.waitpid(pid, 0)
+
+    with open(report_path) as f:
+        report = json.load(f)
+    os.unlink(report_path)
+
+    report['terminal_bytes'] = terminal_bytes
+    return report
+
+
+def format_report(report):
+    out = [
+        f"capture:        {report['capture']} ({report['terminal']})",
+        f"input:          {report['bytes']} bytes, {report['lines']} lines in {report['seconds']:.3f}s",
+        f"throughput:     {report['lines_per_second']:.0f} lines/s, {report['bytes_per_second'] / 1e6:.2f} MB/s",
+        f"render:         {report['frames']} frames, {report['render_seconds']:.3f}s",
+        f"peak RSS:       {report['peak_rss_kb'] / 1024:.1f} MiB",
+    ]
+    if 'terminal_bytes' in report:
+        out.append(f"terminal out:   {report['terminal_bytes']} bytes")
+
+    out.append('handlers:')
+    for name, stats in report['handlers'].items():
+        per_call = stats['seconds'] / stats['count'] * 1e6 if stats['count'] else 0.0
+        out.append(
+            f"  {name:40} {stats['count']:>9} calls {stats['seconds']:>8.3f}s "
+            f"{per_call:>8.2f}us/call p99 {stats['p99'] * 1e6:>8.2f}us {stats['match_rate']:>6.1%} routed")
+
+    return '\n'.join(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a capture through muddy and report performance')
+    parser.add_argument('capture', help='capture file recorded with --record')
+    parser.add_argument('--pty', action='store_true', help='render with real curses in a pseudo-terminal')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = run_in_pty(args.capture) if args.pty else run_benchmark(args.capture)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
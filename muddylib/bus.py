@@ -0,0 +1,28 @@
+from pubsub import pub
+
+
+class TopicNamespace:
+    """
+    Scopes pubsub topics to one session, so that e.g. 'MainWindow.add_text'
+    of session 'alt' is published as 'alt.MainWindow.add_text'. The
+    unnamed namespace uses the bare topic names.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.prefix = name + '.' if name else ''
+
+    def topic(self, name):
+        return self.prefix + name
+
+    def send(self, topic, **kwargs):
+        pub.sendMessage(self.prefix + topic, **kwargs)
+
+    def subscribe(self, listener, topic):
+        pub.subscribe(listener, self.prefix + topic)
+
+    def unsubscribe(self, listener, topic):
+        pub.unsubscribe(listener, self.prefix + topic)
+
+
+DEFAULT_NAMESPACE = TopicNamespace()
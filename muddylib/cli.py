@@ -1,6 +1,27 @@
+import argparse
 import curses
 
-from muddylib.session import session_main
-
 if __name__ == '__main__':
-    curses.wrapper(session_main)
+    parser = argparse.ArgumentParser(description='Muddy MUD client')
+    parser.add_argument('--record', metavar='PATH', help='capture the incoming byte stream to PATH')
+    parser.add_argument('--sessions', metavar='PATH', help='run the sessions listed in PATH side by side')
+    parser.add_argument('--daemon', action='store_true', help='run without a terminal, serving frontends on --socket')
+    parser.add_argument('--attach', nargs='?', const='', metavar='SESSION',
+                        help='attach to a running daemon (to its first session unless SESSION is given)')
+    parser.add_argument('--socket', metavar='PATH', help='daemon socket (default: logs/muddy.sock)')
+    args = parser.parse_args()
+
+    # Only import what the chosen mode needs
+    if args.daemon:
+        from muddylib.daemon import DEFAULT_SOCKET, daemon_main
+
+        daemon_main(socket_path=args.socket or DEFAULT_SOCKET, record_path=args.record, sessions_path=args.sessions)
+    elif args.attach is not None:
+        from muddylib.frontend import DEFAULT_SOCKET, frontend_main
+
+        reason = curses.wrapper(frontend_main, socket_path=args.socket or DEFAULT_SOCKET, session=args.attach or None)
+        print(reason)
+    else:
+        from muddylib.session import session_main
+
+        curses.wrapper(session_main, record_path=args.record, sessions_path=args.sessions)
@@ -0,0 +1,124 @@
+import collections
+import itertools
+import re
+
+from twisted.internet import reactor
+
+
+COMMAND_SEPARATOR = ';'
+
+SPEEDWALK_DIRECTIONS = {
+    'n': 'north',
+    's': 'south',
+    'e': 'east',
+    'w': 'west',
+    'u': 'up',
+    'd': 'down'
+}
+
+# A speedwalk needs at least one count, so that plain commands made of
+# direction letters (e.g. "use", "sun") are sent as they are
+SPEEDWALK_RX = re.compile(r'(?=.*\d)(?:\d*[nsewud])+')
+SPEEDWALK_STEP_RX = re.compile(r'(\d*)([nsewud])')
+
+# Upper bound on a single count, against a typo like 300n walking forever
+MAX_SPEEDWALK_REPEAT = 99
+
+CREDIT_EPSILON = 1e-6
+
+
+def expand_speedwalk(text):
+    """3n2e -> ['north', 'north', 'north', 'east', 'east'], or None if text is no speedwalk."""
+    if not SPEEDWALK_RX.fullmatch(text):
+        return None
+
+    steps = []
+    for count, direction in SPEEDWALK_STEP_RX.findall(text):
+        steps.extend([SPEEDWALK_DIRECTIONS[direction]] * min(int(count or 1), MAX_SPEEDWALK_REPEAT))
+    return steps
+
+
+def make_speedwalk(directions):
+    """['north', 'north', 'east'] -> '2n1e', the inverse of expand_speedwalk."""
+    letters = {name: letter for letter, name in SPEEDWALK_DIRECTIONS.items()}
+
+    steps = []
+    for direction, group in itertools.groupby(directions):
+        count = len(list(group))
+        while count:
+            steps.append(f'{min(count, MAX_SPEEDWALK_REPEAT)}{letters[direction]}')
+            count -= min(count, MAX_SPEEDWALK_REPEAT)
+    return ''.join(steps)
+
+
+def expand_commands(text, separator=COMMAND_SEPARATOR):
+    """Splits user input on the separator and expands the speedwalks in it."""
+    commands = []
+    for command in text.split(separator) if separator else [text]:
+        steps = expand_speedwalk(command.strip())
+        if steps is None:
+            commands.append(command)
+        else:
+            commands.extend(steps)
+    return commands
+
+
+class CommandQueue:
+    """
+    Outgoing commands, written to the connection in batches: everything
+    queued within one reactor turn goes out with a single write. With a
+    rate set, commands spend credits that refill at rate per second up
+    to burst, and the rest wait in the queue until cancel() drops them.
+    """
+
+    def __init__(self, write, rate=None, burst=None, clock=reactor):
+        self.write = write
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst or rate
+        self.credits = self.burst
+        self.queue = collections.deque()
+        self._refilled_at = None
+        self._drain_call = None
+
+    def __len__(self):
+        return len(self.queue)
+
+    def send(self, commands):
+        self.queue.extend(commands)
+        self._schedule(0)
+
+    def cancel(self):
+        dropped = len(self.queue)
+        self.queue.clear()
+        if self._drain_call is not None and self._drain_call.active():
+            self._drain_call.cancel()
+        self._drain_call = None
+        return dropped
+
+    def _schedule(self, delay):
+        if self._drain_call is None and self.queue:
+            self._drain_call = self.clock.callLater(delay, self._drain)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        if self._refilled_at is not None:
+            self.credits = min(self.burst, self.credits + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _drain(self):
+        self._drain_call = None
+
+        count = len(self.queue)
+        if self.rate:
+            self._refill()
+            count = min(count, int(self.credits + CREDIT_EPSILON))
+            self.credits -= count
+
+        if count:
+            self.write([self.queue.popleft() for _ in range(count)])
+
+        if self.queue:
+            # Wait for the next whole credit, but never for less than a
+            # millisecond: float rounding must not turn this into a spin
+            self._schedule(max((1 - self.credits) / self.rate, 0.001))
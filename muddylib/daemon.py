@@ -0,0 +1,166 @@
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from muddylib import headless
+from muddylib.headless import HeadlessScreen
+from muddylib.session import MudClient, MudWindowSession, load_sessions
+from muddylib.windows import BufferedTextWindow, StaticWindow
+
+
+DEFAULT_SOCKET = 'logs/muddy.sock'
+
+# Attach messages carry whole batches of lines, one JSON document per line
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+DEFAULT_SYNC_ROWS = 100
+
+
+class DaemonSession(MudWindowSession):
+    def setup_terminal(self):
+        # Frontends get the window contents, never the daemon's drawing
+        headless.install(paint=False)
+
+
+class AttachProtocol(LineReceiver):
+    """
+    Daemon side of a frontend connection. The frontend sends JSON messages:
+
+        {"type": "attach", "session": name or null, "rows": visible rows}
+        {"type": "input", "text": "..."}
+
+    and gets the window layout, the visible tail of every window, and from
+    then on batches of pre-parsed lines: {"type": "update", "window": name,
+    "method": "add_runs" or "set_runs", "lines": [[[text, style], ...], ...]}.
+    """
+
+    delimiter = b'\n'
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.session = None
+        self._pending = []
+        self._flush_call = None
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            self.transport.loseConnection()
+            return
+
+        if message.get('type') == 'attach':
+            self.attach(message)
+        elif message.get('type') == 'input' and self.session:
+            self.session.namespace.send('Core.user_input_received', input_text=message['text'])
+        elif message.get('type') == 'cancel' and self.session:
+            self.session.cancel_commands()
+
+    def attach(self, message):
+        self.session = self.factory.daemon.find_session(message.get('session'))
+        if self.session is None:
+            self.send_message({'type': 'error', 'text': f'No session {message.get("session")}'})
+            self.transport.loseConnection()
+            return
+
+        self.send_message({'type': 'layout', 'windows': self.session.screen_config})
+
+        rows = message.get('rows', DEFAULT_SYNC_ROWS)
+        for win in self.session.mud_screen.windows:
+            if isinstance(win, BufferedTextWindow):
+                self.send_update(win.name, 'add_runs', win.tail(rows))
+            elif isinstance(win, StaticWindow):
+                self.send_update(win.name, 'set_runs', win.buffer)
+
+        self.factory.daemon.frontends.add(self)
+
+    def window_changed(self, window, method, lines):
+        # Coalesce everything that happens within one reactor iteration
+        if self._pending and self._pending[-1][0] == window.name and method == 'add_runs' == self._pending[-1][1]:
+            self._pending[-1][2].extend(lines)
+        else:
+            self._pending.append((window.name, method, list(lines)))
+
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self._flush_call = None
+        pending, self._pending = self._pending, []
+        for name, method, lines in pending:
+            self.send_update(name, method, lines)
+
+    def send_update(self, name, method, lines):
+        self.send_message({'type': 'update', 'window': name, 'method': method, 'lines': lines})
+
+    def send_message(self, message):
+        self.sendLine(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+    def connectionLost(self, reason):
+        self.factory.daemon.frontends.discard(self)
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+
+
+class AttachFactory(Factory):
+    protocol = AttachProtocol
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+
+class MudDaemon(MudClient):
+    """
+    Runs sessions without a terminal. Windows keep their scrollback but
+    never draw; frontends attach over a UNIX socket to watch and type.
+    """
+
+    def __init__(self, sessions, socket_path=DEFAULT_SOCKET):
+        super(MudDaemon, self).__init__(None, sessions)
+        self.socket_path = socket_path
+        self.frontends = set()
+
+        for sess in self.sessions:
+            sess.deactivate()
+            for win in sess.mud_screen.windows:
+                win.mirror = lambda window, method, lines, sess=sess: self._window_changed(sess, window, method, lines)
+
+    def find_session(self, name):
+        if name is None:
+            return self.sessions[0]
+
+        for sess in self.sessions:
+            if sess.name == name:
+                return sess
+
+        return None
+
+    def run(self):
+        for sess in self.sessions:
+            sess.connect()
+
+        directory = os.path.dirname(self.socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        reactor.listenUNIX(self.socket_path, AttachFactory(self), mode=0o600, wantPID=True)
+
+        reactor.addSystemEventTrigger('after', 'shutdown', self.close)
+
+        config = self.sessions[0].session_config.get('metrics', {})
+        if config.get('enabled'):
+            self.start_metrics(config)
+
+        reactor.run()
+
+    def _window_changed(self, sess, window, method, lines):
+        for frontend in self.frontends:
+            if frontend.session is sess:
+                frontend.window_changed(window, method, lines)
+
+
+def daemon_main(socket_path=DEFAULT_SOCKET, record_path=None, sessions_path=None):
+    screen = HeadlessScreen()
+    MudDaemon(load_sessions(DaemonSession, screen, sessions_path, record_path), socket_path).run()
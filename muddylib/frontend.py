@@ -0,0 +1,132 @@
+import json
+
+import curses
+import curses.ascii as asc
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+
+from muddylib.bus import DEFAULT_NAMESPACE
+from muddylib.daemon import DEFAULT_SOCKET, MAX_MESSAGE_LENGTH
+from muddylib.keyboard import KeyboardReader
+from muddylib.screen import MudScreen
+from muddylib.session import handle_search_key
+from muddylib.windows import palette
+
+
+class FrontendProtocol(LineReceiver):
+    delimiter = b'\n'
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.factory.frontend.connected(self)
+
+    def lineReceived(self, line):
+        self.factory.frontend.message_received(json.loads(line))
+
+    def send_message(self, message):
+        self.sendLine(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+    def connectionLost(self, reason):
+        self.factory.frontend.disconnected(reason)
+
+
+class FrontendFactory(ClientFactory):
+    protocol = FrontendProtocol
+
+    def __init__(self, frontend):
+        self.frontend = frontend
+
+    def clientConnectionFailed(self, connector, reason):
+        self.frontend.disconnected(reason)
+
+
+class Frontend:
+    """
+    Curses view of a session running in muddylib.daemon. ESC d (or ESC q)
+    detaches, leaving the session running; ESC c cancels queued commands.
+    """
+
+    def __init__(self, screen, socket_path=DEFAULT_SOCKET, session=None):
+        self.screen = screen
+        self.socket_path = socket_path
+        self.session = session
+        self.connection = None
+        self.mud_screen = None
+        self.escape_pending = False
+        self.exit_reason = None
+
+        curses.noecho()
+        curses.cbreak()
+        palette.init()
+
+    def run(self):
+        reactor.connectUNIX(self.socket_path, FrontendFactory(self))
+
+        self.keyboard = KeyboardReader(self.screen, self._key_handler)
+        self.keyboard.start(reactor)
+
+        reactor.run(installSignalHandlers=0)
+
+        return self.exit_reason
+
+    def connected(self, connection):
+        self.connection = connection
+        rows, columns = self.screen.getmaxyx()
+        connection.send_message({'type': 'attach', 'session': self.session, 'rows': rows})
+
+    def message_received(self, message):
+        if message['type'] == 'layout':
+            if self.mud_screen is None:
+                self.mud_screen = MudScreen(self.screen, message['windows'])
+                DEFAULT_NAMESPACE.subscribe(self._input_handler, 'Core.user_input_received')
+                self.mud_screen.refresh_all()
+        elif message['type'] == 'update':
+            lines = [[tuple(run) for run in runs] for runs in message['lines']]
+            DEFAULT_NAMESPACE.send(message['window'] + '.' + message['method'], lines=lines)
+        elif message['type'] == 'error':
+            self.exit_reason = message['text']
+
+    def disconnected(self, reason):
+        if self.exit_reason is None:
+            self.exit_reason = reason.getErrorMessage()
+        if reactor.running:
+            self.keyboard.stop(reactor)
+            reactor.stop()
+
+    def detach(self):
+        self.exit_reason = 'Detached'
+        if self.connection:
+            self.connection.transport.loseConnection()
+        else:
+            self.disconnected(None)
+
+    def _input_handler(self, input_text):
+        self.connection.send_message({'type': 'input', 'text': input_text})
+
+    def _key_handler(self, key):
+        if self.escape_pending:
+            self.escape_pending = False
+            if key in (ord('d'), ord('q')):
+                self.detach()
+            elif key == ord('c') and self.connection:
+                self.connection.send_message({'type': 'cancel'})
+            elif self.mud_screen is not None:
+                handle_search_key(DEFAULT_NAMESPACE, key)
+        elif key == asc.ESC:
+            self.escape_pending = True
+        elif self.mud_screen is None or key == -1:
+            pass
+        elif key == curses.KEY_RESIZE:
+            self.mud_screen.resize()
+        elif key == curses.KEY_PPAGE:
+            DEFAULT_NAMESPACE.send('MainWindow.scroll', num_rows=-10)
+        elif key == curses.KEY_NPAGE:
+            DEFAULT_NAMESPACE.send('MainWindow.scroll', num_rows=10)
+        else:
+            DEFAULT_NAMESPACE.send('InputWindow.process_key', key=key)
+
+
+def frontend_main(screen, socket_path=DEFAULT_SOCKET, session=None):
+    return Frontend(screen, socket_path, session).run()
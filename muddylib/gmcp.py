@@ -0,0 +1,117 @@
+import json
+
+
+# Packages that carry one-off events rather than state; their messages are
+# always delivered in full instead of being diffed against the state tree
+EVENT_PACKAGES = ('comm',)
+
+# Packages whose every message describes the whole thing anew (e.g. the
+# room just entered), so it replaces the last one instead of merging into
+# it; handlers get the full message whenever it differs
+SNAPSHOT_PACKAGES = ('room.info',)
+
+DEFAULT_SUPPORTS = ['Char 1', 'Room 1', 'Comm 1']
+
+
+def parse_message(payload):
+    text = payload.decode('utf-8', errors='replace')
+    package, _, body = text.partition(' ')
+    body = body.strip()
+
+    return package.lower(), json.loads(body) if body else None
+
+
+def encode_message(package, data=None):
+    if data is None:
+        return package.encode('utf-8')
+
+    return (package + ' ' + json.dumps(data)).encode('utf-8')
+
+
+def package_matches(package, prefix):
+    return package == prefix or package.startswith(prefix + '.')
+
+
+class GmcpState:
+    """
+    Merged tree of the last known value of every GMCP package, e.g.
+    ``state.get('char.vitals')``. Updates return only what changed.
+    """
+
+    def __init__(self, event_packages=EVENT_PACKAGES, snapshot_packages=SNAPSHOT_PACKAGES):
+        self.tree = {}
+        self.event_packages = event_packages
+        self.snapshot_packages = snapshot_packages
+
+    def get(self, package, default=None):
+        node = self.tree
+        for key in package.lower().split('.'):
+            if not isinstance(node, dict) or key not in node:
+                return default
+            node = node[key]
+
+        return node
+
+    def is_event(self, package):
+        return any(package_matches(package, p) for p in self.event_packages)
+
+    def update(self, package, data):
+        *parents, leaf = package.split('.')
+        node = self.tree
+        for key in parents:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+
+        if isinstance(data, dict) and isinstance(node.get(leaf), dict) and package not in self.snapshot_packages:
+            return merge(node[leaf], data)
+
+        if leaf in node and node[leaf] == data:
+            return None
+
+        node[leaf] = data
+
+        return data
+
+
+def merge(target, data):
+    changes = {}
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            nested = merge(target[key], value)
+            if nested:
+                changes[key] = nested
+        elif key not in target or target[key] != value:
+            target[key] = value
+            changes[key] = value
+
+    return changes
+
+
+class GmcpEngine:
+    """
+    Keeps the GMCP state tree up to date and passes the changed keys of
+    every message to the plugin handlers subscribed to its package prefix.
+    """
+
+    def __init__(self, plugin_manager, error_handler=None):
+        self.plugin_manager = plugin_manager
+        self.error_handler = error_handler
+        self.state = GmcpState()
+
+    def message_received(self, package, data):
+        if self.state.is_event(package):
+            changes = data
+        else:
+            changes = self.state.update(package, data)
+            if changes is None or changes == {}:
+                return
+
+        for handler in self.plugin_manager.get_gmcp_handlers(package):
+            try:
+                handler(package, changes, self.state)
+            except:
+                if self.error_handler:
+                    self.error_handler()
+                else:
+                    raise
@@ -0,0 +1,161 @@
+from muddylib.render import RenderScheduler
+from muddylib.windows import Window, palette
+
+
+class HeadlessError(Exception):
+    pass
+
+
+class HeadlessWindow:
+    """
+    In-memory stand-in for a curses window. It keeps a character grid so
+    that drawing costs roughly what it would against a real terminal.
+    """
+
+    def __init__(self, lines, columns, y=0, x=0):
+        self.lines = lines
+        self.columns = columns
+        self.y = y
+        self.x = x
+        self.cursor_y = 0
+        self.cursor_x = 0
+        self.cells = [[' '] * columns for l in range(lines)]
+
+    def getmaxyx(self):
+        return self.lines, self.columns
+
+    def resize(self, lines, columns):
+        self.lines = lines
+        self.columns = columns
+        self.cells = [[' '] * columns for l in range(lines)]
+
+    def mvwin(self, y, x):
+        self.y = y
+        self.x = x
+
+    def move(self, y, x):
+        if not (0 <= y < self.lines and 0 <= x < self.columns):
+            raise HeadlessError('move() out of window', y, x)
+
+        self.cursor_y = y
+        self.cursor_x = x
+
+    def addstr(self, text, attr=0):
+        row = self.cells[self.cursor_y]
+        for char in text:
+            if self.cursor_x >= self.columns:
+                if self.cursor_y + 1 >= self.lines:
+                    raise HeadlessError('addstr() past the end of window')
+                self.cursor_y += 1
+                self.cursor_x = 0
+                row = self.cells[self.cursor_y]
+
+            row[self.cursor_x] = char
+            self.cursor_x += 1
+
+    def addch(self, y, x, char):
+        self.move(y, x)
+        self.cells[y][x] = char if type(char) == str else '+'
+
+    def hline(self, y, x, char, length):
+        for xx in range(x, min(x + length, self.columns)):
+            self.addch(y, xx, char)
+
+    def scroll(self, lines=1):
+        lines = min(lines, self.lines)
+        del self.cells[:lines]
+        self.cells.extend([' '] * self.columns for l in range(lines))
+
+    def erase(self):
+        self.cells = [[' '] * self.columns for l in range(self.lines)]
+
+    clear = erase
+
+    def clrtoeol(self):
+        row = self.cells[self.cursor_y]
+        row[self.cursor_x:] = [' '] * (self.columns - self.cursor_x)
+
+    def row_text(self, y):
+        return ''.join(self.cells[y]).rstrip()
+
+    def refresh(self):
+        pass
+
+    def touchwin(self):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+    def scrollok(self, flag):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def getch(self):
+        return -1
+
+
+class NullWindow(HeadlessWindow):
+    """
+    Stand-in that only keeps its geometry, for when nobody will ever look
+    at the screen: drawing into it costs nothing.
+    """
+
+    def __init__(self, lines, columns, y=0, x=0):
+        self.lines = lines
+        self.columns = columns
+        self.y = y
+        self.x = x
+        self.cursor_y = 0
+        self.cursor_x = 0
+
+    def resize(self, lines, columns):
+        self.lines = lines
+        self.columns = columns
+
+    def move(self, y, x):
+        pass
+
+    def addstr(self, text, attr=0):
+        pass
+
+    def addch(self, y, x, char):
+        pass
+
+    def hline(self, y, x, char, length):
+        pass
+
+    def scroll(self, lines=1):
+        pass
+
+    def erase(self):
+        pass
+
+    clear = erase
+
+    def clrtoeol(self):
+        pass
+
+    def row_text(self, y):
+        return ''
+
+
+class HeadlessScreen(HeadlessWindow):
+    def __init__(self, lines=50, columns=160):
+        super(HeadlessScreen, self).__init__(lines, columns)
+
+
+def install(paint=True):
+    """
+    Routes all window creation and screen updates to the headless stand-in;
+    without paint, windows keep their contents but draw nothing at all.
+    """
+    Window.window_factory = staticmethod(HeadlessWindow if paint else NullWindow)
+    Window.painting = paint
+    RenderScheduler.doupdate = staticmethod(lambda: None)
+    palette.init_headless()
@@ -0,0 +1,66 @@
+import codecs
+import locale
+import sys
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.task import LoopingCall
+
+
+# ncurses only reports KEY_RESIZE from getch(), and SIGWINCH does not make
+# stdin readable, so the keyboard is also polled at this interval
+RESIZE_POLL_INTERVAL = 0.25
+
+
+@implementer(IReadDescriptor)
+class KeyboardReader:
+    """
+    Feeds curses key presses into the reactor, so that input, network and
+    rendering all run on the reactor thread. getch() hands over a multibyte
+    character one byte at a time, so bytes are decoded in the terminal's
+    encoding: ASCII arrives as before, as its code, other characters as
+    one-character strings, since their code points would clash with the
+    curses key codes.
+    """
+
+    def __init__(self, screen, key_handler, encoding=None):
+        self.screen = screen
+        self.key_handler = key_handler
+        self.screen.nodelay(True)
+
+        encoding = encoding or locale.getpreferredencoding(False)
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+
+        self._poll = LoopingCall(self.doRead)
+
+    def start(self, reactor):
+        reactor.addReader(self)
+        self._poll.start(RESIZE_POLL_INTERVAL, now=False)
+
+    def stop(self, reactor):
+        reactor.removeReader(self)
+        if self._poll.running:
+            self._poll.stop()
+
+    def fileno(self):
+        return sys.stdin.fileno()
+
+    def doRead(self):
+        while True:
+            key = self.screen.getch()
+            if key == -1:
+                return
+
+            if key >= 0x100:
+                self.key_handler(key)
+                continue
+
+            for char in self.decoder.decode(bytes([key])):
+                self.key_handler(ord(char) if char < '\x80' else char)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'KeyboardReader'
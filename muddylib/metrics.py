@@ -0,0 +1,251 @@
+import json
+import math
+import threading
+import time
+
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from muddylib.plugins import handler_name
+
+
+# Histogram buckets grow by a factor of 2^(1/BUCKETS_PER_OCTAVE) starting
+# at one microsecond, which bounds percentile error to about 19%
+BUCKETS_PER_OCTAVE = 4
+BUCKET_COUNT = 30 * BUCKETS_PER_OCTAVE
+
+SLOW_REPORT_INTERVAL = 10.0
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        us = seconds * 1e6
+        index = int(math.log2(us) * BUCKETS_PER_OCTAVE) + 1 if us >= 1 else 0
+        self.buckets[min(index, BUCKET_COUNT - 1)] += 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+
+        wanted = fraction * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted:
+                return min(2 ** (index / BUCKETS_PER_OCTAVE) / 1e6, self.max)
+
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'seconds': self.total,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class HandlerStats(LatencyHistogram):
+    def __init__(self):
+        super(HandlerStats, self).__init__()
+        self.matches = 0
+
+    def as_dict(self):
+        result = super(HandlerStats, self).as_dict()
+        result['matches'] = self.matches
+        result['match_rate'] = self.matches / self.count if self.count else 0.0
+        return result
+
+
+class Metrics:
+    """
+    Process-wide counters for the incoming text pipeline: time spent in
+    every plugin handler, latency from receiving data to drawing it,
+    lines waiting for the next frame and bytes on the wire.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.latency = LatencyHistogram()
+        self.slow_handler_threshold = None
+        self.slow_handler_reporter = None
+
+        self.bytes_in_wire = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines_in = 0
+
+        self.render_queue_depth = 0
+        self.max_render_queue_depth = 0
+
+        self._pending_since = None
+        self._slow_reported = {}
+
+    def wrap_handler(self, handler):
+        name = handler_name(handler)
+        stats = self.handlers.setdefault(name, HandlerStats())
+
+        def instrumented(*args):
+            started = time.perf_counter()
+            result = handler(*args)
+            elapsed = time.perf_counter() - started
+
+            stats.record(elapsed)
+            if result:
+                stats.matches += 1
+            if self.slow_handler_threshold is not None and elapsed > self.slow_handler_threshold:
+                self._report_slow(name, elapsed)
+
+            return result
+
+        instrumented.muddy_handler_name = name
+        return instrumented
+
+    def data_received(self, wire_bytes, data_bytes):
+        self.bytes_in_wire += wire_bytes
+        self.bytes_in += data_bytes
+        if self._pending_since is None:
+            self._pending_since = time.perf_counter()
+
+    def data_sent(self, nbytes):
+        self.bytes_out += nbytes
+
+    def lines_received(self, count):
+        self.lines_in += count
+        self.render_queue_depth += count
+        if self.render_queue_depth > self.max_render_queue_depth:
+            self.max_render_queue_depth = self.render_queue_depth
+
+    def frame_rendered(self):
+        if self._pending_since is not None:
+            self.latency.record(time.perf_counter() - self._pending_since)
+            self._pending_since = None
+
+        self.render_queue_depth = 0
+
+    def _report_slow(self, name, elapsed):
+        if threading.current_thread() is not threading.main_thread():
+            # Offloaded handlers may take their time, they block nothing
+            return
+
+        now = time.monotonic()
+        if now - self._slow_reported.get(name, -SLOW_REPORT_INTERVAL) < SLOW_REPORT_INTERVAL:
+            return
+
+        self._slow_reported[name] = now
+        if self.slow_handler_reporter:
+            self.slow_handler_reporter(name, elapsed)
+
+    def as_dict(self):
+        return {
+            'handlers': {name: stats.as_dict() for name, stats in sorted(self.handlers.items())},
+            'latency': self.latency.as_dict(),
+            'bytes_in_wire': self.bytes_in_wire,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'lines_in': self.lines_in,
+            'render_queue_depth': self.render_queue_depth,
+            'max_render_queue_depth': self.max_render_queue_depth,
+        }
+
+    def summary_lines(self):
+        lines = [
+            f'in {self.bytes_in_wire}B wire/{self.bytes_in}B data',
+            f'out {self.bytes_out}B, {self.lines_in} lines',
+            f'lat p99 {self.latency.percentile(0.99) * 1e3:.1f}ms',
+            f'queue {self.render_queue_depth}/{self.max_render_queue_depth}',
+        ]
+        top = sorted(self.handlers.items(), key=lambda item: -item[1].total)
+        for name, stats in top:
+            lines.append(f'{name.split(".")[0][:18]:18} {stats.total * 1e3:7.0f}ms p99 {stats.percentile(0.99) * 1e6:5.0f}us')
+
+        return lines
+
+    def prometheus_text(self):
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f'# HELP muddy_{name} {help_text}')
+            out.append(f'# TYPE muddy_{name} {kind}')
+            for labels, value in samples:
+                out.append(f'muddy_{name}{labels} {value}')
+
+        metric('bytes_received_total', 'counter', 'Bytes received', [
+            ('{stage="wire"}', self.bytes_in_wire),
+            ('{stage="decompressed"}', self.bytes_in)])
+        metric('bytes_sent_total', 'counter', 'Bytes sent', [('', self.bytes_out)])
+        metric('lines_received_total', 'counter', 'Lines received', [('', self.lines_in)])
+        metric('render_queue_depth', 'gauge', 'Lines waiting for the next frame', [('', self.render_queue_depth)])
+        metric('latency_seconds', 'summary', 'Time from receiving data to drawing it', [
+            ('{quantile="0.5"}', self.latency.percentile(0.5)),
+            ('{quantile="0.99"}', self.latency.percentile(0.99)),
+            ('_sum', self.latency.total),
+            ('_count', self.latency.count)])
+
+        handler_samples = []
+        for name, stats in sorted(self.handlers.items()):
+            label = f'handler="{name}"'
+            handler_samples += [
+                (f'{{{label},quantile="0.99"}}', stats.percentile(0.99)),
+                (f'_sum{{{label}}}', stats.total),
+                (f'_count{{{label}}}', stats.count)]
+        metric('handler_seconds', 'summary', 'Time spent in plugin handlers', handler_samples)
+        metric('handler_matches_total', 'counter', 'Handler calls that routed the line',
+               [(f'{{handler="{name}"}}', stats.matches) for name, stats in sorted(self.handlers.items())])
+
+        return '\n'.join(out) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsExportProtocol(LineReceiver):
+    """
+    Answers one request per connection: 'json' or 'prometheus' on a line
+    of its own, or an HTTP GET for /metrics (Prometheus) or /metrics.json.
+    """
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        request = line.decode('ascii', errors='replace').strip()
+
+        if request.startswith('GET '):
+            path = request.split(' ')[1]
+            if path.endswith('.json'):
+                body, content_type = self._json(), 'application/json'
+            else:
+                body, content_type = self._prometheus(), 'text/plain; version=0.0.4'
+            self.transport.write(
+                b'HTTP/1.0 200 OK\r\nContent-Type: ' + content_type.encode('ascii') +
+                b'\r\nContent-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+        elif request == 'json':
+            self.transport.write(self._json())
+        else:
+            self.transport.write(self._prometheus())
+
+        self.transport.loseConnection()
+
+    def _json(self):
+        return json.dumps(self.factory.metrics.as_dict(), indent=2).encode('utf-8')
+
+    def _prometheus(self):
+        return self.factory.metrics.prometheus_text().encode('utf-8')
+
+
+class MetricsExportFactory(Factory):
+    protocol = MetricsExportProtocol
+
+    def __init__(self, metrics):
+        self.metrics = metrics
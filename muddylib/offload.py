@@ -0,0 +1,75 @@
+import threading
+from collections import deque
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+
+DEFAULT_OFFLOAD_THREADS = 4
+
+
+def on_reactor_thread():
+    # The reactor always runs on the main thread
+    return threading.current_thread() is threading.main_thread()
+
+
+class SerialExecutor:
+    """
+    Runs calls on a thread pool one after another, in the order they were
+    submitted, so that a plugin sees its lines in order even off-thread.
+    Coroutine functions run on the reactor thread as Deferreds instead.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._queue = deque()
+        self._running = False
+
+    def submit(self, func, args, coroutine=False):
+        result = defer.Deferred()
+        self._queue.append((func, args, coroutine, result))
+        if not self._running:
+            self._run_next()
+
+        return result
+
+    def _run_next(self):
+        if not self._queue:
+            self._running = False
+            return
+
+        self._running = True
+        func, args, coroutine, result = self._queue.popleft()
+
+        if coroutine:
+            d = defer.maybeDeferred(lambda: defer.ensureDeferred(func(*args)))
+        else:
+            d = threads.deferToThreadPool(reactor, self.pool, func, *args)
+
+        d.addBoth(self._finished)
+        d.chainDeferred(result)
+
+    def _finished(self, outcome):
+        self._run_next()
+        return outcome
+
+
+class Offloader:
+    """Thread pool and per-plugin executors of one PluginManager."""
+
+    def __init__(self, threads=DEFAULT_OFFLOAD_THREADS):
+        self.pool = ThreadPool(minthreads=0, maxthreads=threads, name='muddy-offload')
+        self._executors = {}
+
+    def executor(self, key):
+        executor = self._executors.get(key)
+        if executor is None:
+            if not self.pool.started:
+                self.pool.start()
+            executor = self._executors[key] = SerialExecutor(self.pool)
+
+        return executor
+
+    def stop(self):
+        if self.pool.started:
+            self.pool.stop()
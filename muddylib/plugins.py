@@ -1,62 +1,505 @@
 import importlib
+import importlib.util
+import inspect
+import itertools
+import json
+import os
+import sys
 
-from pubsub import pub
+from twisted.internet import reactor
+
+from muddylib.bus import DEFAULT_NAMESPACE
+from muddylib.gmcp import package_matches
+from muddylib.offload import Offloader, on_reactor_thread
+from muddylib.triggers import TriggerDispatcher
 
 
 class MuddyPlugin(object):
     configuration = {}
+    namespace = DEFAULT_NAMESPACE
+    # The session's clock, virtual when replaying; use it for callLater()
+    clock = reactor
+
+    # Attributes that belong to the plugin manager, not to the plugin state
+    manager_attributes = ('configuration', 'namespace', 'clock', 'subscriptions')
     
     def set_configuration(self, config):
         self.configuration = config
     
     def invoke_method(self, component_name, method_name, **kwargs):
-        pub.sendMessage(component_name + '.' + method_name, **kwargs)
+        if on_reactor_thread():
+            self.namespace.send(component_name + '.' + method_name, **kwargs)
+        else:
+            # From an offloaded handler; windows may only be touched on the reactor thread
+            reactor.callFromThread(self.namespace.send, component_name + '.' + method_name, **kwargs)
+
+    def subscribe(self, listener, topic):
+        """Subscribes to a session topic for as long as the plugin is loaded."""
+        if 'subscriptions' not in self.__dict__:
+            self.subscriptions = []
+
+        self.namespace.subscribe(listener, topic)
+        self.subscriptions.append((listener, topic))
+
+    def load(self):
+        """Called once registered, with the namespace set; the place to subscribe()."""
+        pass
+
+    def unload(self):
+        for listener, topic in self.__dict__.pop('subscriptions', []):
+            self.namespace.unsubscribe(listener, topic)
+
+    def get_state(self):
+        """State handed over to the new instance when the plugin is reloaded."""
+        return {k: v for k, v in self.__dict__.items() if k not in self.manager_attributes}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+
+_definition_order = itertools.count()
 
 
 def IncomingTextHandler(func):
     return flag_as_handler(func, 'IncomingTextHandler')
 
 
+def InputHandler(func):
+    """
+    Marks a method as a handler for what the user types, called with the
+    input line before it is sent; returning True keeps it from the server.
+    """
+    return flag_as_handler(func, 'InputHandler')
+
+
+def Trigger(pattern=None, prefix=None, flags=0):
+    """
+    Marks a method as a handler for lines matching a regex and/or starting
+    with a literal prefix (a string or a tuple of strings). The method is
+    called with the line and the match object.
+    """
+    def decorator(func):
+        if not hasattr(func, 'muddy_plugin_triggers'):
+            func.muddy_plugin_triggers = []
+
+        func.muddy_plugin_triggers.append({'pattern': pattern, 'prefix': prefix, 'flags': flags})
+
+        return flag_as_handler(func, 'Trigger')
+
+    return decorator
+
+
+def GmcpHandler(prefix):
+    """
+    Marks a method as a handler for GMCP messages whose package is, or is
+    nested under, the given prefix (e.g. 'char' or 'char.vitals'). The
+    method is called with the package, the changed keys and the GMCP state.
+    """
+    def decorator(func):
+        if not hasattr(func, 'muddy_plugin_gmcp'):
+            func.muddy_plugin_gmcp = []
+
+        func.muddy_plugin_gmcp.append(prefix.lower())
+
+        return flag_as_handler(func, 'GmcpHandler')
+
+    return decorator
+
+
+def Offloaded(func=None, routes=False):
+    """
+    Runs a handler off the reactor thread, so that slow work does not stall
+    the screen or the connection. The plugin's offloaded handlers run one
+    at a time in line order; coroutine functions run as Deferreds instead
+    of on a thread. The routed decision cannot wait for the handler: a
+    line it is offered to counts as routed if and only if routes is set.
+    Exceptions are reported once the handler finishes.
+
+    Use as @Offloaded or @Offloaded(routes=True), above the handler
+    decorators.
+    """
+    def decorator(func):
+        func.muddy_plugin_offload = {'routes': routes, 'coroutine': inspect.iscoroutinefunction(func)}
+        return func
+
+    if func is not None:
+        return decorator(func)
+
+    return decorator
+
+
 def flag_as_handler(func, handler_name):
-    if not hasattr(func, 'muddy_plugin_flags'):
+    if not hasattr(func, 'muddy_plugin_handler'):
         func.muddy_plugin_handler = []
+        func.muddy_plugin_order = next(_definition_order)
 
-    func.muddy_plugin_handler.append(handler_name)
+    if handler_name not in func.muddy_plugin_handler:
+        func.muddy_plugin_handler.append(handler_name)
 
     return func
 
 
+def handler_name(handler):
+    """Readable 'PluginClass.method' name of a handler, also through wrappers."""
+    name = getattr(handler, 'muddy_handler_name', None)
+    if name is None:
+        name = f'{type(handler.__self__).__name__}.{handler.__name__}'
+
+    return name
+
+
+def handler_metadata(plugin_class):
+    """
+    Describes the handlers of a plugin class in definition order, as plain
+    data that can be cached, so that a plugin can be wired up without
+    importing its module.
+    """
+    methods = {}
+    for cls in reversed(plugin_class.__mro__):
+        for name, value in vars(cls).items():
+            if hasattr(value, 'muddy_plugin_handler'):
+                methods[name] = value
+            else:
+                methods.pop(name, None)
+
+    handlers = []
+    for name, func in sorted(methods.items(), key=lambda item: item[1].muddy_plugin_order):
+        triggers = []
+        for trigger in getattr(func, 'muddy_plugin_triggers', []):
+            pattern, flags = trigger['pattern'], trigger['flags']
+            if hasattr(pattern, 'pattern'):
+                pattern, flags = pattern.pattern, pattern.flags
+
+            prefix = trigger['prefix']
+            if prefix is not None and type(prefix) != str:
+                prefix = list(prefix)
+
+            triggers.append({'pattern': pattern, 'prefix': prefix, 'flags': flags})
+
+        handlers.append({
+            'name': name,
+            'flags': list(func.muddy_plugin_handler),
+            'triggers': triggers,
+            'gmcp': list(getattr(func, 'muddy_plugin_gmcp', [])),
+            'offload': getattr(func, 'muddy_plugin_offload', None),
+        })
+
+    # Plugins that subscribe to topics in load() must be loaded up front
+    return {'handlers': handlers, 'eager': plugin_class.load is not MuddyPlugin.load}
+
+
+class HandlerMetadataCache:
+    """
+    handler_metadata() of plugin classes, stored as JSON and valid for as
+    long as the module source keeps its modification time and size.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.dirty = False
+
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _source_stamp(self, module_name):
+        try:
+            spec = importlib.util.find_spec(module_name)
+            st = os.stat(spec.origin)
+        except (ImportError, AttributeError, TypeError, ValueError, OSError):
+            return None
+
+        return [spec.origin, st.st_mtime_ns, st.st_size]
+
+    def get(self, module_name, class_name):
+        entry = self.entries.get(f'{module_name}:{class_name}')
+        if entry is None or entry['source'] != self._source_stamp(module_name):
+            return None
+
+        return entry['metadata']
+
+    def put(self, module_name, class_name, metadata):
+        key = f'{module_name}:{class_name}'
+        entry = {'source': self._source_stamp(module_name), 'metadata': metadata}
+        if entry['source'] is not None and self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.dirty = False
+
+
+class PluginStub:
+    """
+    Stands in for a plugin whose module has not been imported yet. Its
+    handlers are registered from cached metadata and the first call to
+    any of them loads the real plugin in its place.
+    """
+
+    def __init__(self, manager, plugin_def, metadata):
+        self.manager = manager
+        self.definition = plugin_def
+        self.module_name = plugin_def['module']
+        self.class_name = plugin_def['class']
+        self.metadata = metadata
+        self.plugin = None
+
+    def handler(self, name):
+        def lazy_handler(*args):
+            return getattr(self.manager.activate(self), name)(*args)
+
+        lazy_handler.muddy_handler_name = f'{self.class_name}.{name}'
+        return lazy_handler
+
+    def unload(self):
+        pass
+
+
+DEFAULT_METADATA_CACHE = '~/.muddy/plugin_cache.json'
+
+
 class PluginManager:
-    def __init__(self):
+    def __init__(self, namespace=DEFAULT_NAMESPACE, metadata_cache=None, clock=reactor):
+        self.namespace = namespace
+        self.clock = clock
+        self.metadata_cache = metadata_cache
         self.plugins = []
         self.handlers = {
-            'IncomingTextHandler': []
+            'IncomingTextHandler': [],
+            'InputHandler': [],
+            'GmcpHandler': []
         }
+        self.dispatcher = TriggerDispatcher()
+        self._gmcp_routes = {}
+        self._seq = itertools.count()
+        self.handler_wrappers = []
+        self.offloader = None
+
+        # Called with a twisted Failure when an offloaded handler raises
+        self.offload_error_handler = None
+
+        # Called with the module name when a stub's plugin is first imported
+        self.module_imported = None
     
     def load_from_config(self, config):
+        """
+        Creates the configured plugins. With a metadata cache, plugins
+        whose handlers are known from an earlier run are only imported
+        once one of their handlers is first called; 'lazy: false' in a
+        plugin definition opts out.
+        """
         for plugin_def in config['plugins']:
-            module_name = plugin_def['module']
-            class_name = plugin_def['class']
-            
-            module = importlib.import_module(module_name)
-            for thing in dir(module):
-                if thing == class_name:
-                    plugin_class = getattr(module, class_name)
-                    plugin = plugin_class()
-                    if 'configuration' in plugin_def:
-                        plugin.set_configuration(plugin_def['configuration'])
-                    
-                    self.register_plugin(plugin)
+            metadata = None
+            if self.metadata_cache is not None and plugin_def.get('lazy', True):
+                metadata = self.metadata_cache.get(plugin_def['module'], plugin_def['class'])
+
+            if metadata is None or metadata['eager']:
+                plugin = self._create_plugin(plugin_def)
+                if self.metadata_cache is not None:
+                    self.metadata_cache.put(plugin_def['module'], plugin_def['class'], handler_metadata(type(plugin)))
+                self.register_plugin(plugin)
+            else:
+                stub = PluginStub(self, plugin_def, metadata)
+                self.plugins.append(stub)
+                self._add_handlers(stub, self.handlers, self.dispatcher)
+
+        if self.metadata_cache is not None:
+            self.metadata_cache.save()
+
+    def _create_plugin(self, plugin_def):
+        module = importlib.import_module(plugin_def['module'])
+        plugin = getattr(module, plugin_def['class'])()
+        if 'configuration' in plugin_def:
+            plugin.set_configuration(plugin_def['configuration'])
+
+        return plugin
+
+    def activate(self, stub):
+        """Loads the real plugin of a stub, returning it."""
+        if stub.plugin is None:
+            stub.plugin = self._create_plugin(stub.definition)
+            if self.module_imported is not None:
+                self.module_imported(stub.module_name)
+            stub.plugin.namespace = self.namespace
+            stub.plugin.clock = self.clock
+            self.plugins[self.plugins.index(stub)] = stub.plugin
+            self._rebuild()
+            stub.plugin.load()
+
+        return stub.plugin
     
     def register_plugin(self, plugin):
-        # TODO: Duplicate/de-/re-registration
+        if plugin in self.plugins:
+            raise ValueError('Plugin already registered', plugin)
+
+        plugin.namespace = self.namespace
+        plugin.clock = self.clock
         self.plugins.append(plugin)
-        
-        for attr in dir(plugin):
-            method = getattr(plugin, attr)
-            if hasattr(method, 'muddy_plugin_handler'):
-                for handler_name in method.muddy_plugin_handler:
-                    self.handlers[handler_name].append(method)
+        self._add_handlers(plugin, self.handlers, self.dispatcher)
+        plugin.load()
+
+    def unload_plugin(self, plugin):
+        self.plugins.remove(plugin)
+        plugin.unload()
+        self._rebuild()
+
+    def unload_module(self, module_name):
+        for plugin in [p for p in self.plugins if _module_of(p) == module_name]:
+            self.unload_plugin(plugin)
+
+    def reload_module(self, module_name):
+        """
+        Re-imports a plugin module and replaces every plugin created from
+        it with a new instance that takes over its configuration and state.
+        If the module fails to import, the old plugins stay in place.
+        """
+        for stub in [p for p in self.plugins if isinstance(p, PluginStub) and p.module_name == module_name]:
+            self.activate(stub)
+
+        module = importlib.reload(sys.modules[module_name])
+
+        replaced = []
+        for index, plugin in enumerate(self.plugins):
+            if type(plugin).__module__ != module_name:
+                continue
+
+            new_plugin = getattr(module, type(plugin).__name__)()
+            if 'configuration' in plugin.__dict__:
+                new_plugin.set_configuration(plugin.configuration)
+            new_plugin.set_state(plugin.get_state())
+            replaced.append((index, plugin, new_plugin))
+
+        for index, plugin, new_plugin in replaced:
+            plugin.unload()
+            new_plugin.namespace = self.namespace
+            new_plugin.clock = self.clock
+            self.plugins[index] = new_plugin
+
+        self._rebuild()
+
+        for index, plugin, new_plugin in replaced:
+            new_plugin.load()
+
+        return [new_plugin for index, plugin, new_plugin in replaced]
+
+    def plugin_modules(self):
+        return sorted({_module_of(plugin) for plugin in self.plugins})
+
+    def _rebuild(self):
+        # Build into fresh structures and swap them in at once; everything
+        # runs on the reactor thread, so this happens between line batches
+        handlers = {name: [] for name in self.handlers}
+        dispatcher = TriggerDispatcher()
+        for plugin in self.plugins:
+            self._add_handlers(plugin, handlers, dispatcher)
+
+        self.handlers = handlers
+        self.dispatcher = dispatcher
+        self._gmcp_routes = {}
+
+    def _add_handlers(self, plugin, handlers, dispatcher):
+        if isinstance(plugin, PluginStub):
+            metadata = plugin.metadata
+            resolve = plugin.handler
+        else:
+            metadata = handler_metadata(type(plugin))
+            resolve = lambda name: getattr(plugin, name)
+
+        for entry in metadata['handlers']:
+            seq = next(self._seq)
+            method = resolve(entry['name'])
+            flags = entry['flags']
+            triggers = entry['triggers']
+            gmcp_prefixes = entry['gmcp']
+
+            for wrapper in self.handler_wrappers:
+                method = wrapper(method)
+
+            if entry.get('offload'):
+                method = self._offloaded(plugin, method, entry['offload'])
+
+            for flag in flags:
+                if flag == 'Trigger':
+                    for trigger in triggers:
+                        dispatcher.add_trigger(seq, method, **trigger)
+                elif flag == 'GmcpHandler':
+                    for prefix in gmcp_prefixes:
+                        handlers[flag].append((prefix, method))
+                    self._gmcp_routes = {}
+                else:
+                    handlers[flag].append(method)
+                    if flag == 'IncomingTextHandler':
+                        dispatcher.add_handler(seq, method)
     
     def get_handlers(self, handler_name):
         return self.handlers[handler_name]
+
+    def match_handlers(self, line):
+        return self.dispatcher.match(line)
+
+    def wrap_handlers(self, wrapper):
+        """
+        Replaces every handler with wrapper(handler), including those of
+        plugins registered later. Offloaded handlers are wrapped on the
+        thread they run on.
+        """
+        self.handler_wrappers.append(wrapper)
+        self._rebuild()
+
+    def _offloaded(self, plugin, method, offload):
+        if self.offloader is None:
+            self.offloader = Offloader()
+
+        class_name = plugin.class_name if isinstance(plugin, PluginStub) else type(plugin).__name__
+        executor = self.offloader.executor(f'{_module_of(plugin)}.{class_name}')
+        routes = offload['routes']
+        coroutine = offload['coroutine']
+
+        def dispatch(*args):
+            if isinstance(plugin, PluginStub):
+                # Load on the reactor thread, not in the worker
+                self.activate(plugin)
+
+            d = executor.submit(method, args, coroutine)
+            d.addErrback(self._offload_failed)
+            return routes
+
+        dispatch.muddy_handler_name = handler_name(method)
+        return dispatch
+
+    def _offload_failed(self, failure):
+        if self.offload_error_handler:
+            self.offload_error_handler(failure)
+        else:
+            failure.printTraceback()
+
+    def close(self):
+        if self.offloader is not None:
+            self.offloader.stop()
+
+    def get_gmcp_handlers(self, package):
+        handlers = self._gmcp_routes.get(package)
+        if handlers is None:
+            handlers = []
+            for prefix, method in self.handlers['GmcpHandler']:
+                if package_matches(package, prefix) and method not in handlers:
+                    handlers.append(method)
+            self._gmcp_routes[package] = handlers
+
+        return handlers
+
+
+def _module_of(plugin):
+    return plugin.module_name if isinstance(plugin, PluginStub) else type(plugin).__module__
@@ -0,0 +1,122 @@
+import importlib.util
+import os
+import sys
+
+from twisted.internet.task import LoopingCall
+
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+except ImportError:
+    inotify = None
+
+
+POLL_INTERVAL = 1.0
+
+# Editors tend to write a file in several steps; reload once they are done
+RELOAD_DELAY = 0.2
+
+
+class PluginReloader:
+    """
+    Reloads the plugin modules of a PluginManager whose source files
+    changed since they were loaded. reload_changed() checks on demand,
+    watch() keeps checking, through inotify where available and by
+    polling modification times otherwise.
+    """
+
+    def __init__(self, plugin_manager, on_reloaded, on_error):
+        self.plugin_manager = plugin_manager
+        self.on_reloaded = on_reloaded
+        self.on_error = on_error
+
+        self._mtimes = {}
+        for module_name in self.plugin_manager.plugin_modules():
+            if module_name in sys.modules:
+                self._mtimes[module_name] = self._mtime(module_name)
+        plugin_manager.module_imported = self._module_imported
+
+        self._notifier = None
+        self._poll = None
+        self._pending = None
+
+    def _mtime(self, module_name):
+        path = getattr(sys.modules.get(module_name), '__file__', None)
+        try:
+            return os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            return None
+
+    def _module_imported(self, module_name):
+        # A lazily loaded plugin: what it runs is the source as of now
+        if module_name not in self._mtimes:
+            self._mtimes[module_name] = self._mtime(module_name)
+
+    def reload_changed(self):
+        self._pending = None
+
+        reloaded = []
+        for module_name in self.plugin_manager.plugin_modules():
+            mtime = self._mtime(module_name)
+            if mtime is None or mtime == self._mtimes.get(module_name):
+                continue
+
+            if module_name not in self._mtimes:
+                # Imported since by other means; nothing to compare with
+                self._mtimes[module_name] = mtime
+                continue
+
+            self._mtimes[module_name] = mtime
+            try:
+                self.plugin_manager.reload_module(module_name)
+            except:
+                self.on_error()
+                continue
+
+            reloaded.append(module_name)
+            self.on_reloaded(module_name)
+
+        return reloaded
+
+    def watch(self, clock):
+        self.clock = clock
+
+        if inotify is not None:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+                for directory in self._directories():
+                    self._notifier.watch(
+                        FilePath(directory),
+                        mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO,
+                        callbacks=[self._file_changed])
+                return
+            except Exception:
+                # No inotify on this system after all
+                self._notifier = None
+
+        self._poll = LoopingCall(self.reload_changed)
+        self._poll.clock = clock
+        self._poll.start(POLL_INTERVAL, now=False)
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+        if self._poll is not None and self._poll.running:
+            self._poll.stop()
+        if self._pending is not None and self._pending.active():
+            self._pending.cancel()
+
+    def _directories(self):
+        directories = set()
+        for module_name in self.plugin_manager.plugin_modules():
+            spec = importlib.util.find_spec(module_name)
+            if spec is not None and spec.origin:
+                directories.add(os.path.dirname(os.path.abspath(spec.origin)))
+
+        return sorted(directories)
+
+    def _file_changed(self, watch, path, mask):
+        if os.fsdecode(path.path).endswith('.py') and self._pending is None:
+            self._pending = self.clock.callLater(RELOAD_DELAY, self.reload_changed)
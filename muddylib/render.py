@@ -0,0 +1,74 @@
+import curses
+import time
+
+from twisted.internet import reactor
+
+from muddylib.metrics import metrics
+
+
+DEFAULT_MAX_FPS = 30
+
+
+class RenderScheduler:
+    """
+    Coalesces screen updates into frames. Windows mark themselves dirty
+    after changing their contents; at most max_fps times a second every
+    dirty window gets to render its pending changes and is staged with
+    noutrefresh, followed by a single doupdate. The cursor window is
+    staged last so the terminal cursor ends up there.
+    """
+
+    # Replaced by a no-op when rendering into the headless stand-in
+    doupdate = staticmethod(curses.doupdate)
+
+    def __init__(self, max_fps=DEFAULT_MAX_FPS, clock=reactor):
+        self.frame_interval = 1.0 / max_fps
+        self.clock = clock
+        self.cursor_window = None
+
+        self.frames = 0
+        self.render_seconds = 0.0
+
+        # Set while the screen belongs to a session that is not on display
+        self.suspended = False
+
+        self._dirty = {}
+        self._frame_call = None
+        self._last_frame = 0.0
+
+    def mark_dirty(self, window):
+        self._dirty[window] = True
+
+        if self._frame_call is None and not self.suspended:
+            self._schedule()
+
+    def _schedule(self):
+        delay = max(self._last_frame + self.frame_interval - time.monotonic(), 0)
+        self._frame_call = self.clock.callLater(delay, self.flush)
+
+    def flush(self):
+        if self._frame_call is not None:
+            if self._frame_call.active():
+                self._frame_call.cancel()
+            self._frame_call = None
+
+        if self.suspended:
+            return
+
+        started = self._last_frame = time.monotonic()
+
+        dirty = self._dirty
+        self._dirty = {}
+
+        for window in dirty:
+            window.render()
+            window.window.noutrefresh()
+
+        if self.cursor_window is not None:
+            self.cursor_window.window.noutrefresh()
+
+        self.doupdate()
+        metrics.frame_rendered()
+
+        self.frames += 1
+        self.render_seconds += time.monotonic() - started
@@ -0,0 +1,275 @@
+import re
+
+import muddylib.ansi as ansi
+import muddylib.colors as clr
+from muddylib.triggers import BACKREFERENCE_RX, SCOPED_FLAGS
+from muddylib.yaml import load as yload
+
+
+COLOR_NAMES = {
+    'black': clr.BLACK,
+    'red': clr.RED,
+    'green': clr.GREEN,
+    'yellow': clr.YELLOW,
+    'blue': clr.BLUE,
+    'magenta': clr.MAGENTA,
+    'cyan': clr.CYAN,
+    'white': clr.WHITE,
+}
+
+STYLE_FLAGS = {
+    'bold': ansi.BOLD,
+    'underline': ansi.UNDERLINE,
+    'reverse': ansi.REVERSE,
+}
+
+# Flags such as (?i) at the start of a pattern, which are only allowed
+# there and so are turned into scoped ones when patterns are fused
+GLOBAL_FLAGS_RX = re.compile(r'^(?:\(\?[imsx]+\))+')
+
+GROUP_NAME_RX = re.compile(r'(\(\?P<)(\w+)>')
+
+# Style of highlights that do not give one, which would otherwise do nothing
+DEFAULT_HIGHLIGHT_STYLE = {'reverse': True}
+
+# Names are only highlighted as whole words, not inside longer ones
+WORD_START = r'(?<!\w)'
+WORD_END = r'(?!\w)'
+
+
+def parse_color(value):
+    """A palette index from 0-255 or a color name, optionally 'bright ...'."""
+    if isinstance(value, int):
+        return value & 0xff
+
+    words = str(value).lower().split()
+    if not words or words[-1] not in COLOR_NAMES or words[:-1] not in ([], ['bright']):
+        raise ValueError(f'Unknown color {value!r}')
+
+    return COLOR_NAMES[words[-1]] + (clr.BRIGHT if words[:-1] else 0)
+
+
+def parse_style(config):
+    """
+    (mask, bits) of a style override such as {fg: bright red, bold: true}:
+    a style s becomes (s & ~mask) | bits, so that whatever the rule does not
+    mention is left as the MUD sent it.
+    """
+    mask, bits = 0, 0
+    for key, value in (config or {}).items():
+        if key == 'fg':
+            mask |= ansi.COLOR_MASK
+            bits |= ansi.with_fg(0, parse_color(value))
+        elif key == 'bg':
+            mask |= ansi.COLOR_MASK << ansi.COLOR_BITS
+            bits |= ansi.with_bg(0, parse_color(value))
+        elif key in STYLE_FLAGS:
+            mask |= STYLE_FLAGS[key]
+            bits |= STYLE_FLAGS[key] if value else 0
+        else:
+            raise ValueError(f'Unknown style attribute {key!r}')
+
+    return mask, bits
+
+
+def trie_pattern(words):
+    """
+    A regex matching any of words, built as a trie so that it branches on
+    one character at a time instead of trying every word in turn. Longer
+    words win over their prefixes.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if '' in node:
+            return f'(?:{"|".join(branches)})?'
+        if len(branches) == 1:
+            return branches[0]
+        return f'(?:{"|".join(branches)})'
+
+    return emit(trie)
+
+
+def style_at(runs, offset):
+    """Style of the character at offset, or of the last one if offset is at the end."""
+    pos = 0
+    style = ansi.DEFAULT
+    for text, style in runs:
+        pos += len(text)
+        if pos > offset:
+            break
+
+    return style
+
+
+def apply_edits(runs, edits):
+    """
+    Applies (start, end, text, (mask, bits)) edits, ascending and not
+    overlapping, to runs: text replaces the characters between start and
+    end, or None restyles them in place.
+    """
+    result = []
+    cut = 0
+    for start, end, text, (mask, bits) in edits:
+        result.extend(ansi.slice_runs(runs, cut, start))
+        if text is None:
+            result.extend((piece, (style & ~mask) | bits) for piece, style in ansi.slice_runs(runs, start, end))
+        else:
+            result.append((text, (style_at(runs, start) & ~mask) | bits))
+        cut = end
+
+    result.extend(ansi.slice_runs(runs, cut, sum(len(text) for text, style in runs)))
+    return tuple(ansi.merge_runs(result))
+
+
+class RewriteRule:
+    def __init__(self, kind, regex, replacement=None, style=(0, 0)):
+        self.kind = kind
+        self.regex = regex
+        self.replacement = replacement
+        self.style = style
+        # Replacements without group references need no second match
+        self.template = replacement is not None and '\\' in replacement
+
+    @classmethod
+    def from_config(cls, config):
+        flags = re.IGNORECASE if config.get('ignore_case') else 0
+        style = parse_style(config.get('style'))
+
+        if 'gag' in config:
+            return cls('gag', re.compile(config['gag'], flags))
+
+        if 'substitute' in config:
+            return cls('substitute', re.compile(config['substitute'], flags), config.get('replacement', ''), style)
+
+        if 'highlight' in config:
+            pattern = config['highlight']
+            if not isinstance(pattern, str):
+                names = {name.lower() if flags else name for name in pattern if name}
+                pattern = WORD_START + trie_pattern(names) + WORD_END
+            if not config.get('style'):
+                style = parse_style(DEFAULT_HIGHLIGHT_STYLE)
+            return cls('highlight', re.compile(pattern, flags), style=style)
+
+        raise ValueError(f'Rewrite rule needs gag, substitute or highlight: {config!r}')
+
+    def fused_pattern(self, prefix):
+        """
+        The pattern for use inside an alternation of several rules, or None
+        if it cannot be: leading global flags such as (?i) become scoped
+        ones and named groups get prefix, so that rules cannot clash.
+        """
+        if BACKREFERENCE_RX.search(self.regex.pattern):
+            return None
+
+        pattern = GLOBAL_FLAGS_RX.sub('', self.regex.pattern)
+        pattern = GROUP_NAME_RX.sub(lambda m: f'{m.group(1)}{prefix}{m.group(2)}>', pattern)
+        flags = ''.join(f for flag, f in SCOPED_FLAGS if self.regex.flags & flag)
+        pattern = f'(?{flags}:{pattern})' if flags else f'(?:{pattern})'
+
+        try:
+            re.compile(pattern)
+        except re.error:
+            return None
+        return pattern
+
+    def edit(self, text, m):
+        if self.replacement is None:
+            return m.start(), m.end(), None, self.style
+
+        replacement = self.replacement
+        if self.template:
+            replacement = self.regex.match(text, m.start()).expand(replacement)
+        return m.start(), m.end(), replacement, self.style
+
+
+class RewriteRules:
+    """
+    Gags, substitutions and highlights applied to lines on their way to the
+    main window, on the parsed (text, style) runs rather than on escape
+    codes. All gags are fused into one regex and all other rules into a
+    second one with a named group per rule, so a line costs two scans
+    however many rules or names there are. Rules that cannot be fused, e.g.
+    referring back to their own groups, are scanned on their own. Where
+    rules match at the same position the first listed wins.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+        fused_gags = []
+        self._gags = []
+        fused = []
+        self._edits = {}
+        self._unfused = []
+        for seq, rule in enumerate(self.rules):
+            name = f'r{seq}'
+            pattern = rule.fused_pattern(name + '_')
+            if rule.kind == 'gag':
+                if pattern is None:
+                    self._gags.append(rule.regex)
+                else:
+                    fused_gags.append(pattern)
+            elif pattern is None:
+                self._unfused.append((seq, rule))
+            else:
+                self._edits[name] = (seq, rule)
+                fused.append(f'(?P<{name}>{pattern})')
+
+        if fused_gags:
+            self._gags.insert(0, re.compile('|'.join(fused_gags)))
+        self._scan = re.compile('|'.join(fused)) if fused else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(RewriteRule.from_config(rule) for rule in (config or {}).get('rules') or ())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_config(yload(f.read()))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def rewrite(self, line):
+        """Runs of a line (with ANSI escapes) after the rules, or None if it is gagged."""
+        runs = ansi.parse(line)
+        if not self.rules:
+            return runs
+
+        text = ansi.plain_text(runs) if '\x1b' in line else line
+        for gag in self._gags:
+            if gag.search(text):
+                return None
+
+        edits = self._find_edits(text)
+        return apply_edits(runs, edits) if edits else runs
+
+    def _find_edits(self, text):
+        hits = []
+        if self._scan is not None:
+            hits = [(m.start(), *self._edits[m.lastgroup], m) for m in self._scan.finditer(text) if m.end() > m.start()]
+        if not self._unfused:
+            return [rule.edit(text, m) for start, seq, rule, m in hits]
+
+        for seq, rule in self._unfused:
+            hits.extend((m.start(), seq, rule, m) for m in rule.regex.finditer(text) if m.end() > m.start())
+        hits.sort(key=lambda hit: hit[:2])
+
+        # Leftmost first, then in rule order, skipping whatever overlaps a match already taken
+        edits = []
+        cut = 0
+        for start, seq, rule, m in hits:
+            if start >= cut:
+                edits.append(rule.edit(text, m))
+                cut = m.end()
+        return edits
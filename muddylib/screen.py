@@ -1,78 +1,143 @@
 import curses
 
+from twisted.internet import reactor
+
+from muddylib.bus import DEFAULT_NAMESPACE
+from muddylib.render import RenderScheduler, DEFAULT_MAX_FPS
 from muddylib.windows import BufferedTextWindow, InputWindow, LayoutElement, StaticWindow
 
 
+# Number of terminal sizes whose layout solution is kept
+LAYOUT_CACHE_SIZE = 64
+
+
 class MudScreen(object):
-    def __init__(self, screen, screen_config):
+    def __init__(self, screen, screen_config, clock=reactor, namespace=DEFAULT_NAMESPACE):
         self.screen = screen
         self.screen.keypad(True)
         self.screen.scrollok(False)
 
-        maker = LayoutMaker()
+        maker = LayoutMaker(namespace)
         root, windows = maker.make_from(screen_config['root'])
         self.root = root
         self.windows = windows
 
-    def refresh_all(self):
-        self.screen.clear()
-
-        y, x = self.screen.getmaxyx()
-        x = x-1  # Issue with curses - last column is not really supported
-
-        self.root.resize(y, x, 0, 0)
+        self._layouts = {}
+        self._size = None
 
-        pmap = PixMap(y, x)
+        self.render_scheduler = RenderScheduler(max_fps=screen_config.get('max_fps', DEFAULT_MAX_FPS), clock=clock)
         for win in self.windows:
-            pmap.paint_window(win.lines, win.columns, win.y, win.x)
+            win.render_scheduler = self.render_scheduler
+            if isinstance(win, InputWindow):
+                self.render_scheduler.cursor_window = win
 
-        for yy in range(y):
-            for xx in range(x):
-                if pmap.get_state(yy, xx):
-                    try:
-                        self.screen.addch(yy, xx, adjacency_to_char(pmap.get_adjacency(yy, xx)))
-                    except:
-                        #This empty catch is a curses workaround
-                        pass
+    def activate(self):
+        self.render_scheduler.suspended = False
+        self.refresh_all()
 
-        self.screen.refresh()
+    def deactivate(self):
+        self.render_scheduler.suspended = True
 
-        for win in self.windows:
-            win.redraw()
-
-
-class PixMap:
-    def __init__(self, lines, columns):
-        self.lines = lines
-        self.columns = columns
-
-        self._bitmap = [[True for c in range(columns)] for r in range(lines)]
-
-    def paint_window(self, lines, columns, y, x):
-        for r in range(y, y + lines):
-            for c in range(x, x + columns):
-                self._bitmap[r][c] = False
+    def refresh_all(self):
+        """Repaints everything, e.g. when the screen was drawn over by another session."""
+        if self.render_scheduler.suspended:
+            return
 
-    def get_state(self, y, x):
-        if x < 0 or x >= self.columns or y < 0 or y >= self.lines:
-            return False
+        self.screen.clear()
+        self._apply_layout(repaint=True)
+
+    def resize(self):
+        """Follows a terminal resize, redrawing only the windows whose geometry changed."""
+        if self.render_scheduler.suspended:
+            return
+
+        if self.screen.getmaxyx() == self._size:
+            return
+
+        self.screen.erase()
+        self._apply_layout(repaint=False)
+
+    def _apply_layout(self, repaint):
+        self._size = self.screen.getmaxyx()
+        geometry, borders = self._solve(*self._size)
+
+        for y, x, adj, length in borders:
+            try:
+                if length > 1:
+                    self.screen.hline(y, x, adjacency_to_char(adj), length)
+                else:
+                    self.screen.addch(y, x, adjacency_to_char(adj))
+            except:
+                #This empty catch is a curses workaround
+                pass
+
+        self.screen.noutrefresh()
+
+        for win, lines, columns, y, x in geometry:
+            if (lines, columns, y, x) != (win.lines, win.columns, win.y, win.x):
+                win.resize(lines, columns, y, x)
+            elif repaint:
+                win.redraw()
+            else:
+                # Unchanged, but the erased screen was copied over it
+                win.window.touchwin()
+                win.invalidate()
+
+        self.render_scheduler.flush()
+
+    def _solve(self, y, x):
+        layout = self._layouts.get((y, x))
+        if layout is None:
+            if len(self._layouts) >= LAYOUT_CACHE_SIZE:
+                del self._layouts[next(iter(self._layouts))]
+
+            columns = x - 1  # Issue with curses - last column is not really supported
+            geometry = self.root.layout(y, columns, 0, 0)
+            layout = self._layouts[(y, x)] = (geometry, border_segments(y, columns, geometry))
+
+        return layout
+
+
+def border_segments(lines, columns, geometry):
+    """
+    Border cells are all cells not covered by a window. Returns them as
+    (y, x, adjacency, length) runs of equal glyphs along each row, where
+    adjacency has bit 1 set if the cell above is a border too, 2 right,
+    4 below and 8 left.
+    """
+    rows = [bytearray(b'\x01') * columns for yy in range(lines)]
+    for win, win_lines, win_columns, y, x in geometry:
+        left = max(x, 0)
+        right = min(x + win_columns, columns)
+        if right <= left:
+            continue
+
+        blank = bytes(right - left)
+        for yy in range(max(y, 0), min(y + win_lines, lines)):
+            rows[yy][left:right] = blank
+
+    empty = bytearray(columns)
+    segments = []
+    for yy, row in enumerate(rows):
+        above = rows[yy - 1] if yy > 0 else empty
+        below = rows[yy + 1] if yy + 1 < lines else empty
+
+        xx = row.find(1)
+        while xx != -1:
+            adj = above[xx] + \
+                  2 * (xx + 1 < columns and row[xx + 1]) + \
+                  4 * below[xx] + \
+                  8 * (xx > 0 and row[xx - 1])
+
+            if segments and segments[-1][0] == yy and segments[-1][2] == adj and \
+                    segments[-1][1] + segments[-1][3] == xx:
+                segments[-1][3] += 1
+            else:
+                segments.append([yy, xx, adj, 1])
 
-        return self._bitmap[y][x]
+            xx = row.find(1, xx + 1)
 
-    def get_adjacency(self, y, x):
-        """
-            +---+
-            | 1 |
-        +---+---+---+
-        | 8 | * | 2 |
-        +---+---+---+
-            | 4 |
-            +---+
-        """
-        return 1 * self.get_state(y-1, x) +\
-               2 * self.get_state(y, x+1) +\
-               4 * self.get_state(y+1, x) +\
-               8 * self.get_state(y, x-1)
+    return [tuple(segment) for segment in segments]
 
 
 def adjacency_to_char(adj):
@@ -113,7 +178,7 @@ class AbstractStackLayout(LayoutElement):
         self.layouts = config['layouts']
         self.elements = []
 
-        maker = LayoutMaker()
+        maker = LayoutMaker(self.namespace)
         windows = []
 
         for elem in config['elements']:
@@ -127,35 +192,43 @@ class AbstractStackLayout(LayoutElement):
         self.elements.append(element)
         self.layouts.append(layout)
 
-
-class VerticalStackLayout(AbstractStackLayout):
     def resize(self, lines, columns, y, x):
-        super(VerticalStackLayout, self).resize(lines, columns, y, x)
+        super(AbstractStackLayout, self).resize(lines, columns, y, x)
 
+        for win, win_lines, win_columns, win_y, win_x in self.layout(lines, columns, y, x):
+            win.resize(win_lines, win_columns, win_y, win_x)
+
+
+class VerticalStackLayout(AbstractStackLayout):
+    def layout(self, lines, columns, y, x):
         actuals = [element.lines for element in self.elements]
         new_lines = compute_layout(lines, self.layouts, actuals)
         new_ys = cumsum_w_borders(new_lines)
 
+        geometry = []
         for e, element in enumerate(self.elements):
             if type(element) in [VerticalStackLayout, HorizontalStackLayout]:
-                element.resize(new_lines[e]+2, columns, new_ys[e]-1, x)
+                geometry.extend(element.layout(new_lines[e]+2, columns, new_ys[e]-1, x))
             else:
-                element.resize(new_lines[e], columns-2, new_ys[e], x+1)
+                geometry.extend(element.layout(new_lines[e], columns-2, new_ys[e], x+1))
 
+        return geometry
 
-class HorizontalStackLayout(AbstractStackLayout):
-    def resize(self, lines, columns, y, x):
-        super(HorizontalStackLayout, self).resize(lines, columns, y, x)
 
+class HorizontalStackLayout(AbstractStackLayout):
+    def layout(self, lines, columns, y, x):
         actuals = [element.columns for element in self.elements]
         new_columns = compute_layout(columns, self.layouts, actuals)
         new_xs = cumsum_w_borders(new_columns)
 
+        geometry = []
         for e, element in enumerate(self.elements):
             if type(element) in [VerticalStackLayout, HorizontalStackLayout]:
-                element.resize(lines, new_columns[e]+2, y, new_xs[e]-1)
+                geometry.extend(element.layout(lines, new_columns[e]+2, y, new_xs[e]-1))
             else:
-                element.resize(lines-2, new_columns[e], y+1, new_xs[e])
+                geometry.extend(element.layout(lines-2, new_columns[e], y+1, new_xs[e]))
+
+        return geometry
 
 
 def compute_layout(total, layouts, actuals):
@@ -197,7 +270,9 @@ def cumsum_w_borders(arr):
 
 
 class LayoutMaker:
-    def __init__(self):
+    def __init__(self, namespace=DEFAULT_NAMESPACE):
+        self.namespace = namespace
+
         classes = [
             BufferedTextWindow,
             InputWindow,
@@ -217,6 +292,7 @@ class LayoutMaker:
             raise ValueError('Unsupported layout element type', elem_type)
 
         root = self._class_map[elem_type]()
+        root.namespace = self.namespace
         windows = root.init_from_config(config)
 
         return root, windows
@@ -0,0 +1,281 @@
+from array import array
+from bisect import bisect_right
+
+from muddylib.wrap import text_width
+
+
+DEFAULT_MAX_LINES = 100000
+
+# Evicted bytes are only reclaimed once at least this many lines (and at
+# least half of the index) are dead, which keeps eviction amortized O(1)
+COMPACT_MIN_LINES = 1024
+
+RUN_LENGTH_SHIFT = 32
+RUN_STYLE_MASK = (1 << RUN_LENGTH_SHIFT) - 1
+
+LINE_SEPARATOR = ord('\n')
+
+
+def unpack_runs(text, packed_runs):
+    """(text, style) runs of a line from its text and packed (length, style) integers."""
+    runs = []
+    pos = 0
+    for packed in packed_runs:
+        length = packed >> RUN_LENGTH_SHIFT
+        runs.append((text[pos:pos + length], packed & RUN_STYLE_MASK))
+        pos += length
+
+    return tuple(runs)
+
+
+class ScrollbackBuffer:
+    """
+    Bounded store of pre-parsed lines. The plain text of every line is kept
+    as UTF-8 in one shared bytearray arena, each line followed by a newline
+    so that the arena can be searched directly, and its (text, style) runs
+    as packed (length, style) integers in a second array, so no Python
+    object is held per line. The display width of every line is worked
+    out once, on append, for wrapping.
+
+    Offsets are positions in the logical stream of everything ever
+    appended; ``_base``/``_run_base`` are the stream positions of the
+    first element still held. Eviction only advances the head, the dead
+    prefix is dropped in bulk.
+
+    With an archive attached every line is also written to disk, and the
+    line(), line_text() and line_width() accessors, which take absolute
+    line numbers, fall through to it for lines evicted from memory.
+    """
+
+    def __init__(self, max_lines=DEFAULT_MAX_LINES, max_bytes=None):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        self._arena = bytearray()
+        self._offsets = array('Q')
+        self._base = 0
+        self._end = 0
+
+        self._runs = array('Q')
+        self._run_offsets = array('Q')
+        self._run_base = 0
+
+        # (cells << 1) | simple, see display_width()
+        self._widths = array('Q')
+
+        self._head = 0
+
+        self.appended = 0
+        self.archive = None
+
+    def __len__(self):
+        return len(self._offsets) - self._head
+
+    def __getitem__(self, index):
+        i = self._index(index)
+
+        return unpack_runs(self._text_at(i), self._runs_at(i))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def text(self, index):
+        return self._text_at(self._index(index))
+
+    def display_width(self, index):
+        """(cells, simple) of a line, as computed by muddylib.wrap.text_width."""
+        packed = self._widths[self._index(index)]
+        return packed >> 1, bool(packed & 1)
+
+    @property
+    def oldest_line_number(self):
+        """Absolute number of the oldest line available, from the archive if there is one."""
+        return self.archive.start if self.archive else self.first_line_number
+
+    def line(self, line_number):
+        """Runs of a line by absolute number, read from the archive once evicted."""
+        if line_number >= self.first_line_number or not self.archive:
+            return self[line_number - self.first_line_number]
+
+        text, runs, width = self.archive.line(line_number)
+        return unpack_runs(text, runs)
+
+    def line_text(self, line_number):
+        if line_number >= self.first_line_number or not self.archive:
+            return self.text(line_number - self.first_line_number)
+
+        return self.archive.line(line_number)[0]
+
+    def line_width(self, line_number):
+        """(cells, simple) of a line by absolute number, see display_width()."""
+        if line_number >= self.first_line_number or not self.archive:
+            return self.display_width(line_number - self.first_line_number)
+
+        packed = self.archive.line(line_number)[2]
+        return packed >> 1, bool(packed & 1)
+
+    def attach_archive(self, archive, restore_lines):
+        """
+        Starts writing to archive, after loading up to restore_lines of its
+        newest lines; the line numbers continue from the archive's.
+        """
+        lines = list(self)
+        self._clear()
+
+        self.appended = max(archive.line_count - restore_lines, archive.start)
+        for line_number in range(self.appended, archive.line_count):
+            text, runs, width = archive.line(line_number)
+            self._store(text.encode('utf-8'), runs, width)
+
+        self.archive = archive
+        for runs in lines:
+            self.append(runs)
+
+    @property
+    def nbytes(self):
+        return self._end - self._offsets[self._head] if len(self) else 0
+
+    @property
+    def first_line_number(self):
+        """Absolute number (counting from the start of the session) of the oldest line kept."""
+        return self.appended - len(self)
+
+    @property
+    def start_position(self):
+        return self._offsets[self._head] if len(self) else self._end
+
+    @property
+    def end_position(self):
+        return self._end
+
+    def line_start(self, position):
+        """Stream position of the start of the line holding position."""
+        i = bisect_right(self._offsets, position, self._head) - 1
+        return self._offsets[max(i, self._head)] if len(self) else self._end
+
+    def find_lines(self, regex, start, end):
+        """
+        Absolute numbers of the lines matching regex, a compiled bytes
+        pattern, between the line-aligned stream positions start and end.
+        """
+        start = max(start, self.start_position)
+        end = min(end, self._end)
+        arena = self._arena
+        base = self._base
+
+        lines = []
+        pos = start - base
+        endpos = end - base
+        i = self._head
+        while pos < endpos:
+            m = regex.search(arena, pos, endpos)
+            if m is None or m.start() >= endpos:
+                break
+
+            i = bisect_right(self._offsets, m.start() + base, i) - 1
+            line_end = arena.find(LINE_SEPARATOR, m.start(), endpos)
+            if line_end < 0:
+                line_end = endpos
+
+            # Patterns such as \s or [^x] can run on across the separator,
+            # so such a hit only counts if the line matches on its own
+            if m.end() <= line_end or regex.search(arena, self._offsets[i] - base, line_end):
+                lines.append(self.first_line_number + i - self._head)
+
+            # One hit per line is enough, go on from the next one
+            pos = line_end + 1
+
+        return lines
+
+    def append(self, runs):
+        text = ''.join(text for text, style in runs)
+        data = text.encode('utf-8')
+        packed = array('Q', [(len(text) << RUN_LENGTH_SHIFT) | style for text, style in runs])
+        cells, simple = text_width(text)
+        width = (cells << 1) | simple
+
+        self._store(data, packed, width)
+        if self.archive:
+            self.archive.append(data, packed.tobytes(), width)
+
+    def _store(self, data, packed, width):
+        self._widths.append(width)
+
+        self._offsets.append(self._end)
+        self._arena += data
+        self._arena.append(LINE_SEPARATOR)
+        self._end += len(data) + 1
+
+        self._run_offsets.append(self._run_base + len(self._runs))
+        self._runs.extend(packed)
+
+        self.appended += 1
+
+        self._evict()
+
+    def _clear(self):
+        self._arena = bytearray()
+        self._offsets = array('Q')
+        self._base = self._end = 0
+        self._runs = array('Q')
+        self._run_offsets = array('Q')
+        self._run_base = 0
+        self._widths = array('Q')
+        self._head = 0
+
+    def _index(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError('scrollback index out of range')
+
+        return self._head + index
+
+    def _text_at(self, i):
+        start = self._offsets[i] - self._base
+        if i + 1 < len(self._offsets):
+            end = self._offsets[i + 1] - self._base
+        else:
+            end = self._end - self._base
+
+        return self._arena[start:end - 1].decode('utf-8')
+
+    def _runs_at(self, i):
+        start = self._run_offsets[i] - self._run_base
+        if i + 1 < len(self._run_offsets):
+            end = self._run_offsets[i + 1] - self._run_base
+        else:
+            end = len(self._runs)
+
+        return self._runs[start:end]
+
+    def _evict(self):
+        while len(self) > 1 and self._over_limit():
+            self._head += 1
+
+        if self._head >= COMPACT_MIN_LINES and self._head * 2 >= len(self._offsets):
+            self._compact()
+
+    def _over_limit(self):
+        if self.max_lines is not None and len(self) > self.max_lines:
+            return True
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            return True
+
+        return False
+
+    def _compact(self):
+        new_base = self._offsets[self._head]
+        del self._arena[:new_base - self._base]
+        del self._offsets[:self._head]
+        del self._widths[:self._head]
+        self._base = new_base
+
+        new_run_base = self._run_offsets[self._head]
+        del self._runs[:new_run_base - self._run_base]
+        del self._run_offsets[:self._head]
+        self._run_base = new_run_base
+
+        self._head = 0
@@ -0,0 +1,125 @@
+import re
+from bisect import bisect_left, bisect_right
+
+
+# Bytes of scrollback scanned per reactor iteration, small enough to keep
+# incoming text flowing while a search runs
+SEARCH_CHUNK_BYTES = 1 << 18
+
+
+def compile_pattern(pattern, literal=False):
+    """
+    Compiles the bytes pattern used to scan the scrollback arena and the
+    text one used to highlight single lines. All-lowercase patterns are
+    case-insensitive.
+    """
+    flags = re.IGNORECASE if pattern == pattern.lower() else 0
+    if literal:
+        pattern = re.escape(pattern)
+
+    return re.compile(pattern.encode('utf-8'), flags | re.MULTILINE), re.compile(pattern, flags)
+
+
+class ScrollbackSearch:
+    """
+    Lines of a ScrollbackBuffer matching a pattern, kept as ascending
+    absolute line numbers. The buffer is scanned newest first in chunks
+    spread over reactor iterations (all at once without a clock), and
+    lines appended later are checked as they arrive.
+    """
+
+    def __init__(self, buffer, pattern, literal=False, clock=None, on_update=None):
+        self.buffer = buffer
+        self.pattern = pattern
+        self.literal = literal
+        self.bytes_regex, self.regex = compile_pattern(pattern, literal)
+        self.clock = clock
+        self.on_update = on_update
+
+        self.matches = []
+        self.current = None
+        self.done = False
+
+        self._scanned_from = buffer.end_position
+        self._scanned_to = buffer.end_position
+        self._call = None
+
+    def start(self):
+        if self.clock is None:
+            while not self.done:
+                self._scan_chunk()
+        else:
+            self._call = self.clock.callLater(0, self._scan_chunk)
+
+    def cancel(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _scan_chunk(self):
+        self._call = None
+
+        start = self.buffer.line_start(max(self._scanned_from - SEARCH_CHUNK_BYTES, self.buffer.start_position))
+        found = self.buffer.find_lines(self.bytes_regex, start, self._scanned_from)
+        self.matches[0:0] = found
+        if self.current is not None:
+            self.current += len(found)
+
+        self._scanned_from = start
+        if start <= self.buffer.start_position:
+            self.done = True
+        elif self.clock is not None:
+            self._call = self.clock.callLater(0, self._scan_chunk)
+
+        if self.on_update:
+            self.on_update(self)
+
+    def lines_appended(self):
+        found = self.buffer.find_lines(self.bytes_regex, self._scanned_to, self.buffer.end_position)
+        self._scanned_to = self.buffer.end_position
+        if found:
+            self.matches.extend(found)
+            if self.on_update:
+                self.on_update(self)
+
+    def step(self, direction, from_line):
+        """
+        Moves to the next match in direction (-1 towards older lines)
+        and returns its line number, or None. Without a current match,
+        starts from from_line.
+        """
+        self._drop_evicted()
+        if not self.matches:
+            return None
+
+        if self.current is None:
+            if direction < 0:
+                index = bisect_right(self.matches, from_line) - 1
+            else:
+                index = bisect_left(self.matches, from_line)
+        else:
+            index = self.current + direction
+
+        if not 0 <= index < len(self.matches):
+            return None
+
+        self.current = index
+        return self.matches[index]
+
+    def _drop_evicted(self):
+        evicted = bisect_left(self.matches, self.buffer.first_line_number)
+        if evicted:
+            del self.matches[:evicted]
+            if self.current is not None:
+                self.current = max(self.current - evicted, 0)
+
+    def spans(self, text):
+        return [m.span() for m in self.regex.finditer(text) if m.end() > m.start()]
+
+    def status(self):
+        if self.current is None:
+            position = ''
+        else:
+            position = f'{self.current + 1}/'
+
+        return f'{self.pattern}: {position}{len(self.matches)} matches' + ('' if self.done else '...')
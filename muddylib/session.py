@@ -1,131 +1,456 @@
+import os
+import re
 import traceback
-import threading
-
-from pubsub import pub
 
 import curses
 import curses.ascii as asc
 
 from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import LoopingCall
 
+from muddylib.archive import DEFAULT_RESTORE_LINES, FLUSH_INTERVAL, ArchiveInUse, ScrollbackArchive
 import muddylib.colors as clr
+from muddylib.bus import TopicNamespace
+from muddylib.gmcp import GmcpEngine
+from muddylib.keyboard import KeyboardReader
+from muddylib.metrics import metrics, MetricsExportFactory
 from muddylib.screen import MudScreen
-from muddylib.telnet import MudClientFactory, ConnectionKeeper
-from muddylib.plugins import PluginManager
+from muddylib.sessionlog import SessionLog
+from muddylib.windows import palette, BufferedTextWindow
+from muddylib.telnet import MudClientFactory, ConnectionKeeper, StreamRecorder, PROMPT_FLUSH_DELAY, PROMPT_RX
+from muddylib.plugins import DEFAULT_METADATA_CACHE, HandlerMetadataCache, PluginManager
+from muddylib.reloader import PluginReloader
+from muddylib.rewrite import RewriteRules
 from muddylib.yaml import load as yload
 
 
+DEFAULT_CONFIG = {
+    'session': 'config/aardwolf_session.yml',
+    'plugins': 'config/aardwolf_plugins.yml',
+    'windows': 'config/aardwolf_windows.yml',
+    'rewrite': 'config/aardwolf_rewrite.yml',
+}
+
+
+def handle_search_key(namespace, key):
+    """
+    ESC / searches the main window for a regex, ESC f for a literal
+    string; ESC n and ESC N jump to the previous (older) and next match.
+    ESC ESC leaves the search prompt.
+    """
+    if key == asc.ESC:
+        namespace.send('InputWindow.cancel_search')
+    elif key == ord('/'):
+        namespace.send('InputWindow.start_search', literal=False)
+    elif key == ord('f'):
+        namespace.send('InputWindow.start_search', literal=True)
+    elif key == ord('n'):
+        namespace.send('MainWindow.search_next', direction=-1)
+    elif key == ord('N'):
+        namespace.send('MainWindow.search_next', direction=1)
+    else:
+        return False
+
+    return True
+
+
 class MudWindowSession:
-    def __init__(self, screen):
-        self.logger = open('muddy.log', 'w+')
+    """
+    One character: a connection with its own plugins, windows and logs.
+    Named sessions publish on topics prefixed with their name, so several
+    of them can share the process; see MudClient.
+    """
+
+    clock = reactor
+
+    def __init__(self, screen, name=None, config=DEFAULT_CONFIG, record_path=None):
+        self.name = name
+        self.namespace = TopicNamespace(name)
+
+        self.session_config = yload(open(config['session'], 'r').read())
+        self.session_log = self.open_session_log()
+
+        self.recorder = self.open_recorder(record_path)
         
-        self.plugin_manager = PluginManager()
+        metadata_cache = HandlerMetadataCache(self.session_config.get('plugin_cache', DEFAULT_METADATA_CACHE))
+        self.plugin_manager = PluginManager(self.namespace, metadata_cache=metadata_cache, clock=self.clock)
+        self.plugin_manager.offload_error_handler = self._report_offload_failure
 
-        plugin_config = yload(open('config/aardwolf_plugins.yml', 'r').read())
+        plugin_config = yload(open(config['plugins'], 'r').read())
         self.plugin_manager.load_from_config(plugin_config)
+        self.reloader = PluginReloader(self.plugin_manager, self._report_reload, self._report_reload_error)
 
-        curses.noecho()
-        curses.cbreak()
-
-        curses.start_color()
-        for c in range(16):
-            curses.init_pair(c+1, c, curses.COLOR_BLACK)
+        self.setup_terminal()
 
         self.screen = screen
-        screen_config = yload(open('config/aardwolf_windows.yml', 'r').read())
-        self.mud_screen = MudScreen(screen, screen_config)
+        self.screen_config = yload(open(config['windows'], 'r').read())
+        self.mud_screen = MudScreen(screen, self.screen_config, clock=self.clock, namespace=self.namespace)
+        self.archives = self.open_archives()
+        self.metrics_updater = None
+        self.archive_flusher = None
+        if self.archives:
+            self.archive_flusher = LoopingCall(self.flush_archives)
+            self.archive_flusher.clock = self.clock
+            self.archive_flusher.start(FLUSH_INTERVAL, now=False)
         
-        self.connection_keeper = ConnectionKeeper()
-        pub.subscribe(self._route_incoming_text, 'Core.telnet_received')
-        pub.subscribe(self._input_handler, 'Core.user_input_received')
-        
-        self.app_running = True
+        self.rewrite_path = config.get('rewrite')
+        self.rewrite_rules, self.rewrite_mtime = RewriteRules(), None
+        try:
+            self.rewrite_rules, self.rewrite_mtime = self.load_rewrite_rules()
+        except Exception:
+            # Start without them rather than not at all
+            self._report_handler_error('Error occured when loading rewrite rules:')
+
+        self.gmcp = GmcpEngine(self.plugin_manager, error_handler=self._report_handler_error)
+
+        connection = self.session_config.get('connection', {})
+        self.connection_keeper = ConnectionKeeper(
+            self.namespace, connection.get('command_rate'), connection.get('command_burst'), clock=self.clock)
+        self.namespace.subscribe(self._route_incoming_text, 'Core.telnet_received')
+        self.namespace.subscribe(self.gmcp.message_received, 'Core.gmcp_received')
+        self.namespace.subscribe(self._input_handler, 'Core.user_input_received')
+
+    def open_session_log(self):
+        config = dict(self.session_config.get('logging', {}))
+        if 'path' in config:
+            config['path'] = self.scoped_path(config['path'])
+
+        return SessionLog(error_handler=self._report_log_failure, **config)
+
+    def open_recorder(self, record_path):
+        if record_path is None:
+            record_path = self.session_config.get('recording', {}).get('path')
+
+        return StreamRecorder(self.scoped_path(record_path)) if record_path else None
+
+    def open_archives(self):
+        config = self.session_config.get('scrollback_archive', {})
+        if 'path' not in config:
+            return []
+
+        archives = []
+        for win in self.mud_screen.windows:
+            if win.name in config.get('windows', []) and isinstance(win, BufferedTextWindow):
+                try:
+                    archive = ScrollbackArchive(os.path.join(self.scoped_path(config['path']), win.name))
+                except ArchiveInUse as e:
+                    # E.g. a second client on the same config; it keeps only what fits in memory
+                    self.write_to_main_window(clr.colorify(f'Scrollback not archived: {e}', clr.RED + clr.BRIGHT))
+                    continue
+                win.attach_archive(archive, config.get('restore_lines', DEFAULT_RESTORE_LINES))
+                archives.append(archive)
+
+        return archives
+
+    def flush_archives(self):
+        for archive in self.archives:
+            archive.flush()
+
+    def load_rewrite_rules(self):
+        """(rules, mtime) of the rewrite rules file; no rules if there is none."""
+        if not self.rewrite_path or not os.path.exists(self.rewrite_path):
+            return RewriteRules(), None
+
+        return RewriteRules.load(self.rewrite_path), os.path.getmtime(self.rewrite_path)
+
+    def scoped_path(self, path):
+        """Tells apart the files of sessions sharing a config: logs/muddy.log becomes logs/muddy-<name>.log."""
+        if not self.name:
+            return path
+
+        root, ext = os.path.splitext(path)
+        return f'{root}-{self.name}{ext}'
+
+    def setup_terminal(self):
+        curses.noecho()
+        curses.cbreak()
+
+        palette.init()
 
     def main_loop(self):
-        f = MudClientFactory(lambda x: self._handle_connection_created(x))
-        reactor.connectTCP('aardmud.org', 4000, f)
+        MudClient(self.screen, [self]).run()
 
-        def rrun():
-            reactor.run(installSignalHandlers=0)
+    def connect(self):
+        connection = self.session_config.get('connection', {})
+        prompt_rx = re.compile(connection['prompt_pattern']) if 'prompt_pattern' in connection else PROMPT_RX
+        f = MudClientFactory(lambda x: self._handle_connection_created(x), self.namespace,
+                             connection.get('encoding', 'utf-8'),
+                             connection.get('prompt_flush_delay', PROMPT_FLUSH_DELAY), prompt_rx)
+        reactor.connectTCP(connection.get('host', 'aardmud.org'), connection.get('port', 4000), f)
 
-        r_thread = threading.Thread(target=rrun)
-        r_thread.start()
-        
-        self.mud_screen.refresh_all()
-        while self.app_running:
-            key = self.screen.getch()
-            self._key_handler(key)
+        if self.session_config.get('metrics', {}).get('enabled'):
+            self.start_metrics()
+
+        if self.session_config.get('reload', {}).get('watch'):
+            self.reloader.watch(self.clock)
+
+    def activate(self):
+        self.mud_screen.activate()
+
+    def deactivate(self):
+        self.mud_screen.deactivate()
+
+    def start_metrics(self):
+        config = self.session_config['metrics']
+        self.plugin_manager.wrap_handlers(metrics.wrap_handler)
 
-        r_thread.join()
+        if 'window' in config:
+            window_name = config['window']
+            self.metrics_updater = LoopingCall(
+                lambda: self.namespace.send(window_name + '.set_text', text=metrics.summary_lines()))
+            self.metrics_updater.clock = self.clock
+            self.metrics_updater.start(config.get('window_interval', 1.0))
+
+    def reload_plugins(self):
+        rules_reloaded = self.reload_rewrite_rules()
+        if not self.reloader.reload_changed() and not rules_reloaded:
+            self.write_to_main_window(clr.colorify('No plugin changed', clr.CYAN + clr.BRIGHT))
+
+    def reload_rewrite_rules(self):
+        mtime = os.path.getmtime(self.rewrite_path) if self.rewrite_path and os.path.exists(self.rewrite_path) else None
+        if mtime == self.rewrite_mtime:
+            return False
+
+        try:
+            self.rewrite_rules, self.rewrite_mtime = self.load_rewrite_rules()
+        except Exception:
+            self._report_handler_error('Error occured when reloading rewrite rules:')
+        else:
+            self._report_reload(self.rewrite_path)
+        return True
+
+    def close(self):
+        self.reloader.stop()
+        self.plugin_manager.close()
+        if self.session_log:
+            self.session_log.close()
+        if self.recorder:
+            self.recorder.close()
+        for loop in (self.metrics_updater, self.archive_flusher):
+            if loop and loop.running:
+                loop.stop()
+        for archive in self.archives:
+            archive.close()
 
     def write_to_main_window(self, text):
-        pub.sendMessage('MainWindow.add_text', text=text)
-        pub.sendMessage('InputWindow.refresh')
+        self.namespace.send('MainWindow.add_text', text=text)
 
     def _route_incoming_text(self, text):
         if type(text) == str:
             text = [text]
         
-        for line in text:
-            self.logger.write(repr(line) + '\n')
-        self.logger.flush()
+        if self.session_log:
+            self.session_log.write_lines(text)
+        metrics.lines_received(len(text))
         
         for line in text:
             routed = False
-            for handler in self.plugin_manager.get_handlers('IncomingTextHandler'):
+            for handler, args in self.plugin_manager.match_handlers(line):
                 try:
-                    if handler(line):
+                    if handler(*args):
                         routed = True
                         break
                 except:
-                    pub.sendMessage(
-                        'MainWindow.add_text',
-                        text=clr.colorify('Error occured when processing handler:', clr.RED + clr.BRIGHT))
-                    pub.sendMessage(
-                        'MainWindow.add_text',
-                        text=[clr.colorify(l, clr.RED + clr.BRIGHT) for l in traceback.format_exc().split('\n')])
+                    self._report_handler_error()
 
             if not routed:
-                pub.sendMessage('MainWindow.add_text', text=line)
+                self.show_line(line)
+
+    def show_line(self, line):
+        if not self.rewrite_rules:
+            self.namespace.send('MainWindow.add_text', text=line)
+            return
+
+        runs = self.rewrite_rules.rewrite(line)
+        if runs is not None:
+            self.namespace.send('MainWindow.add_runs', lines=[runs])
+
+    def _report_handler_error(self, title='Error occured when processing handler:'):
+        self.write_to_main_window(
+            clr.colorify(title, clr.RED + clr.BRIGHT))
+        self.write_to_main_window(
+            [clr.colorify(l, clr.RED + clr.BRIGHT) for l in traceback.format_exc().split('\n')])
+
+    def _report_offload_failure(self, failure):
+        self.write_to_main_window(
+            clr.colorify('Error occured when processing offloaded handler:', clr.RED + clr.BRIGHT))
+        self.write_to_main_window(
+            [clr.colorify(l, clr.RED + clr.BRIGHT) for l in failure.getTraceback().split('\n')])
+
+    def _report_log_failure(self, error):
+        self.write_to_main_window(
+            clr.colorify('Session log stopped after an error:', clr.RED + clr.BRIGHT))
+        self.write_to_main_window([clr.colorify(l, clr.RED + clr.BRIGHT) for l in error.split('\n')])
+
+    def _report_reload(self, module_name):
+        self.write_to_main_window(clr.colorify(f'Reloaded {module_name}', clr.CYAN + clr.BRIGHT))
 
-        pub.sendMessage('InputWindow.refresh')
+    def _report_reload_error(self):
+        self._report_handler_error('Error occured when reloading plugin:')
+
+    def report_slow_handler(self, name, elapsed):
+        self.write_to_main_window(clr.colorify(
+            f'Slow handler: {name} took {elapsed * 1000:.1f}ms', clr.CYAN + clr.BRIGHT))
+
+    def handle_key(self, key):
+        if key == curses.KEY_PPAGE:
+            self.namespace.send('MainWindow.scroll', num_rows=-10)
+        elif key == curses.KEY_NPAGE:
+            self.namespace.send('MainWindow.scroll', num_rows=10)
+        else:
+            self.namespace.send('InputWindow.process_key', key=key)
+
+    def _input_handler(self, input_text):
+        self.write_to_main_window(clr.colorify(input_text, clr.YELLOW))
+
+        for handler in self.plugin_manager.get_handlers('InputHandler'):
+            try:
+                if handler(input_text):
+                    return
+            except:
+                self._report_handler_error()
+
+        self.connection_keeper.send_commands(input_text)
+
+    def cancel_commands(self):
+        dropped = self.connection_keeper.cancel_commands()
+        self.write_to_main_window(clr.colorify(f'Cancelled {dropped} queued commands', clr.CYAN + clr.BRIGHT))
+    
+    def _handle_connection_created(self, proto):
+        proto.recorder = self.recorder
+        self.connection_keeper.register(proto)
+
+
+class MudClient:
+    """
+    Drives any number of sessions from the one reactor. Only the active
+    session draws; ESC 1-9 switches to the n-th session, ESC Tab cycles
+    through them, ESC r reloads changed plugins, ESC c drops the commands
+    still queued for sending and ESC q quits.
+    """
+
+    def __init__(self, screen, sessions):
+        self.screen = screen
+        self.sessions = sessions
+        self.active = sessions[0]
+        self.app_running = True
+        self.escape_pending = False
+
+        for sess in self.sessions[1:]:
+            sess.deactivate()
+
+    def run(self):
+        # Paint the layout before anything else, then get connecting
+        self.active.activate()
+        for sess in self.sessions:
+            sess.connect()
+
+        # Everything touching curses runs on the reactor thread: the
+        # keyboard is just another reader next to the telnet connections
+        self.keyboard = KeyboardReader(self.screen, self._key_handler)
+        self.keyboard.start(reactor)
+
+        reactor.addSystemEventTrigger('after', 'shutdown', self.close)
+
+        config = self.sessions[0].session_config.get('metrics', {})
+        if config.get('enabled'):
+            self.start_metrics(config)
+
+        reactor.run(installSignalHandlers=0)
+
+    def start_metrics(self, config):
+        # Metrics are process-wide, so the export and the slow handler
+        # reports are set up once, from the first session's config
+        if 'slow_handler_ms' in config:
+            metrics.slow_handler_threshold = config['slow_handler_ms'] / 1000
+            metrics.slow_handler_reporter = lambda name, elapsed: self.active.report_slow_handler(name, elapsed)
+
+        # Another client may hold the socket or port; carry on without the export then
+        try:
+            if 'unix_socket' in config:
+                # '{pid}' in the path gives every process a socket of its own
+                path = config['unix_socket'].format(pid=os.getpid())
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                reactor.listenUNIX(path, MetricsExportFactory(metrics), wantPID=True)
+            if 'port' in config:
+                reactor.listenTCP(config['port'], MetricsExportFactory(metrics), interface='127.0.0.1')
+        except CannotListenError as e:
+            self.active.write_to_main_window(clr.colorify(f'Metrics export not started: {e}', clr.RED + clr.BRIGHT))
+
+    def switch_to(self, sess):
+        if sess is self.active:
+            return
+
+        self.active.deactivate()
+        self.active = sess
+        self.active.activate()
+
+    def close(self):
+        for sess in self.sessions:
+            sess.close()
 
     def _key_handler(self, key):
-        if key == curses.KEY_RESIZE:
-            self.mud_screen.refresh_all()
-            pub.sendMessage('InputWindow.refresh')
-        elif key == asc.ESC:
-            key = self.screen.getch()
+        if self.escape_pending:
+            self.escape_pending = False
             self._escape_key_handler(key)
+        elif key == curses.KEY_RESIZE:
+            self.active.mud_screen.resize()
+        elif key == asc.ESC:
+            self.escape_pending = True
         elif key == -1:
             pass
-        elif key == curses.KEY_PPAGE:
-            pub.sendMessage('MainWindow.scroll', num_rows=-10)
-            pub.sendMessage('InputWindow.refresh')
-        elif key == curses.KEY_NPAGE:
-            pub.sendMessage('MainWindow.scroll', num_rows=10)
-            pub.sendMessage('InputWindow.refresh')
         else:
-            pub.sendMessage('InputWindow.process_key', key=key)
+            self.active.handle_key(key)
 
     def _escape_key_handler(self, key):
         if key == ord('q'):
             self.app_running = False
-            self.connection_keeper.disconnect()
+            self.keyboard.stop(reactor)
+            for sess in self.sessions:
+                sess.connection_keeper.disconnect()
             reactor.stop()
             return
 
-        self.write_to_main_window(clr.colorify(f'Unhandled escape key: {key}', clr.CYAN + clr.BRIGHT))
+        if isinstance(key, int) and ord('1') <= key <= ord('9') and key - ord('1') < len(self.sessions):
+            self.switch_to(self.sessions[key - ord('1')])
+            return
 
-    def _input_handler(self, input_text):
-        self.write_to_main_window(clr.colorify(input_text, clr.YELLOW))
-        self.connection_keeper.send_data(input_text)
-    
-    def _handle_connection_created(self, proto):
-        self.connection_keeper.register(proto)
+        if key == asc.TAB:
+            index = self.sessions.index(self.active)
+            self.switch_to(self.sessions[(index + 1) % len(self.sessions)])
+            return
+
+        if handle_search_key(self.active.namespace, key):
+            return
+
+        if key == ord('r'):
+            self.active.reload_plugins()
+            return
+
+        if key == ord('c'):
+            self.active.cancel_commands()
+            return
+
+        self.active.write_to_main_window(clr.colorify(f'Unhandled escape key: {key}', clr.CYAN + clr.BRIGHT))
+
+
+def load_sessions(session_class, screen, sessions_path=None, record_path=None):
+    if sessions_path is None:
+        return [session_class(screen, record_path=record_path)]
+
+    sessions_config = yload(open(sessions_path, 'r').read())
+
+    sessions = []
+    for entry in sessions_config['sessions']:
+        config = dict(DEFAULT_CONFIG)
+        config.update((key, entry[key]) for key in DEFAULT_CONFIG if key in entry)
+        sessions.append(session_class(screen, name=entry['name'], config=config, record_path=record_path))
 
+    return sessions
 
-def session_main(screen):
-    sess = MudWindowSession(screen)
 
-    sess.main_loop()
+def session_main(screen, record_path=None, sessions_path=None):
+    MudClient(screen, load_sessions(MudWindowSession, screen, sessions_path, record_path)).run()
@@ -0,0 +1,210 @@
+import bisect
+import gzip
+import os
+import queue
+import struct
+import threading
+import time
+import traceback
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from twisted.internet import reactor
+
+import muddylib.ansi as ansi
+
+
+# Index records: timestamp, offset into the uncompressed log, line number
+INDEX_RECORD = struct.Struct('<dQQ')
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+class SessionLog:
+    """
+    Writes incoming text to disk on a background thread. The network path
+    only enqueues line batches; the writer thread formats them, writes
+    through a large buffer, flushes on a timer and rotates the file by
+    size and/or age. Every segment gets an ``.idx`` file mapping
+    timestamps to offsets in the (uncompressed) segment.
+
+    mode is 'raw' (lines as received, ANSI escapes included) or 'plain'
+    (escapes stripped); compression is None, 'gzip' or 'zstd'.
+
+    If writing fails the log stops: later lines are dropped rather than
+    queued, and error_handler is called on the reactor thread with the
+    traceback.
+    """
+
+    def __init__(self, path='muddy.log', mode='raw', compression=None,
+                 rotate_bytes=None, rotate_seconds=None,
+                 flush_interval=1.0, index_interval=1.0, buffer_size=DEFAULT_BUFFER_SIZE,
+                 error_handler=None):
+        if mode not in ('raw', 'plain'):
+            raise ValueError('Unsupported log mode', mode)
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError('Unsupported log compression', compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd log compression requires the zstandard package')
+
+        self.path = path
+        self.mode = mode
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.buffer_size = buffer_size
+        self.error_handler = error_handler
+        self.failed = False
+
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='SessionLog', daemon=True)
+        self._thread.start()
+
+    def write_lines(self, lines):
+        if not self.failed:
+            self._queue.put((time.time(), lines))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        writer = SegmentWriter(self)
+        try:
+            self._write_loop(writer)
+        except Exception:
+            self._failed(traceback.format_exc())
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    def _write_loop(self, writer):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                writer.flush()
+                continue
+
+            if item is None:
+                break
+
+            timestamp, lines = item
+            writer.write(timestamp, lines)
+
+            if writer.last_flush + self.flush_interval <= time.monotonic():
+                writer.flush()
+
+    def _failed(self, error):
+        self.failed = True
+        # Let go of whatever was queued since
+        self._queue = queue.SimpleQueue()
+        if self.error_handler is not None:
+            reactor.callFromThread(self.error_handler, error)
+
+
+class SegmentWriter:
+    def __init__(self, log):
+        self.log = log
+        self.file = None
+        self.index = None
+        self.last_flush = time.monotonic()
+
+    def write(self, timestamp, lines):
+        if self.file is None or self._should_rotate(timestamp):
+            self._open_segment(timestamp)
+
+        if timestamp >= self.next_index_time:
+            self.index.write(INDEX_RECORD.pack(timestamp, self.offset, self.line_number))
+            self.next_index_time = timestamp + self.log.index_interval
+
+        if self.log.mode == 'plain':
+            lines = [ansi.strip(line) for line in lines]
+
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        self.file.write(data)
+        self.offset += len(data)
+        self.line_number += len(lines)
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.file is not None:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            if not self.raw.closed:
+                self.raw.close()
+            self.index.close()
+            self.file = None
+
+    def _should_rotate(self, timestamp):
+        if self.log.rotate_bytes is not None and self.offset >= self.log.rotate_bytes:
+            return True
+        if self.log.rotate_seconds is not None and timestamp - self.opened_at >= self.log.rotate_seconds:
+            return True
+
+        return False
+
+    def _open_segment(self, timestamp):
+        self.close()
+
+        path = segment_path(self.log.path, timestamp, self.log.compression)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.raw = open(path, 'ab', buffering=self.log.buffer_size)
+        if self.log.compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        elif self.log.compression == 'zstd':
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.file = self.raw
+
+        self.index = open(path + '.idx', 'ab')
+
+        self.opened_at = timestamp
+        self.next_index_time = timestamp
+        self.offset = self.raw.tell() if self.file is self.raw else 0
+        self.line_number = 0
+
+
+def segment_path(path, timestamp, compression=None):
+    root, ext = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))
+    suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+
+    candidate = f'{root}-{stamp}{ext}{suffix}'
+    counter = 1
+    while os.path.exists(candidate):
+        candidate = f'{root}-{stamp}-{counter}{ext}{suffix}'
+        counter += 1
+
+    return candidate
+
+
+def read_index(index_path):
+    with open(index_path, 'rb') as f:
+        data = f.read()
+
+    usable = len(data) - len(data) % INDEX_RECORD.size
+    return [INDEX_RECORD.unpack_from(data, pos) for pos in range(0, usable, INDEX_RECORD.size)]
+
+
+def offset_at(index, timestamp):
+    """Returns (offset, line number) of the last index record at or before timestamp."""
+    pos = bisect.bisect_right([record[0] for record in index], timestamp) - 1
+    if pos < 0:
+        return 0, 0
+
+    return index[pos][1], index[pos][2]
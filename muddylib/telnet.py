@@ -1,75 +1,401 @@
+import codecs
+import re
+import struct
+import time
 import zlib
 
-from pubsub import pub
-
+from twisted.internet import reactor
 from twisted.internet.protocol import ClientFactory
-from twisted.conch.telnet import Telnet
+from twisted.conch.telnet import Telnet, GA, EOR, IAC, SB, SE, WILL, WONT, DO, DONT
+
+import muddylib.ansi as ansi
+from muddylib.bus import DEFAULT_NAMESPACE
+from muddylib.commands import CommandQueue, expand_commands
+from muddylib.gmcp import parse_message, encode_message, DEFAULT_SUPPORTS
+from muddylib.metrics import metrics
+
+
+# Seconds to wait before a trailing partial line that looks like a prompt
+# (one the server did not terminate with GA/EOR) is delivered as a line
+PROMPT_FLUSH_DELAY = 0.15
+
+# What such a prompt ends with, once colors are stripped
+PROMPT_RX = re.compile(r'[>:?\]]\s*$')
+
+MCCP2 = b'V'
+GMCP = b'\xC9'
+
+IAC_SE = IAC + SE
+OPTION_COMMANDS = frozenset((WILL[0], WONT[0], DO[0], DONT[0]))
+
+CAPTURE_MAGIC = b'MUDDYCAP1\n'
+CAPTURE_RECORD = struct.Struct('<dI')
+
+
+class StreamRecorder:
+    """
+    Captures the raw incoming byte stream (after MCCP decompression) as
+    (seconds since start, length) records followed by the data.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.started = time.monotonic()
+
+    def record(self, data):
+        self.file.write(CAPTURE_RECORD.pack(time.monotonic() - self.started, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('Not a muddy capture file', path)
+
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+
+            timestamp, length = CAPTURE_RECORD.unpack(header)
+            yield timestamp, f.read(length)
+
+
+class LineAssembler:
+    def __init__(self, encoding='utf-8'):
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.partial = ''
+        # Length of the partial line already delivered, see deliver_partial()
+        self.delivered = 0
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        if not text:
+            return []
+
+        if '\x00' in text:
+            # Telnet pads a bare CR with NUL
+            text = text.replace('\x00', '')
+
+        if '\n' not in text:
+            self.partial += text
+            return []
+
+        lines = (self.partial + text).split('\n')
+        if self.delivered:
+            # The rest of a line delivered early makes it whole again,
+            # unless there was nothing more to it
+            if not lines[0][self.delivered:].strip('\r'):
+                del lines[0]
+            self.delivered = 0
+        self.partial = lines.pop()
+
+        return [line.strip('\r') for line in lines]
+
+    def flush(self):
+        text = self.partial + self.decoder.decode(b'', final=True)
+        delivered = self.delivered
+        self.partial = ''
+        self.delivered = 0
+
+        if len(text) <= delivered:
+            return []
+
+        return [text.strip('\r')]
+
+    def deliver_partial(self):
+        """
+        The partial line as a line of its own, for a prompt the server did
+        not terminate. It is kept, so that if more of the line follows after
+        all, the whole line is delivered once it ends.
+        """
+        self.delivered = len(self.partial)
+        return [self.partial.strip('\r')]
+
+    @property
+    def has_partial(self):
+        return len(self.partial) > self.delivered
 
 
 class MudProtocol(Telnet):
-    def __init__(self):
+    """
+    Telnet client protocol with its own receive path: instead of the
+    byte-at-a-time state machine of twisted.conch, each chunk is scanned
+    for IAC with bytes.find and the runs of application data in between
+    are handed on as memoryview slices. Subnegotiation handlers in
+    negotiationMap get the payload as bytes, unescaped.
+    """
+
+    clock = reactor
+    recorder = None
+    namespace = DEFAULT_NAMESPACE
+
+    def __init__(self, encoding='utf-8', prompt_flush_delay=PROMPT_FLUSH_DELAY, prompt_rx=PROMPT_RX):
         super().__init__()
+        self.encoding = encoding
         self.decompress = zlib.decompressobj()
-        self.negotiationMap[b'V'] = lambda data: self.compression_negotiated(data)
-        self.negotiationMap[b'\xC9'] = lambda data: self.gmcp(data)
+        self.negotiationMap[MCCP2] = lambda data: self.compression_negotiated(data)
+        self.negotiationMap[GMCP] = lambda data: self.gmcp(data)
+        self.commandMap[GA] = lambda argument: self.prompt_received()
+        self.commandMap[EOR] = lambda argument: self.prompt_received()
         self.compression_enabled = False
 
+        # Incomplete telnet sequence held over from the previous chunk
+        self._carry = b''
+        self._data_bytes = 0
+
+        self.line_assembler = LineAssembler(encoding)
+        self.pending_lines = []
+        self.prompt_flush_delay = prompt_flush_delay
+        self.prompt_rx = prompt_rx
+        self._prompt_flush_call = None
+
+        self.gmcp_supports = list(DEFAULT_SUPPORTS)
+
     def telnet_WILL(self, option):
-        if option == b'V':
-            self.do(b'V')
-        elif option == b'\xC9':
-            self.do(b'\xC9')
+        if option == MCCP2:
+            self.do(MCCP2)
+        elif option == GMCP:
+            self.do(GMCP)
+            self.send_gmcp('Core.Hello', {'client': 'muddy', 'version': '0.1'})
+            self.send_gmcp('Core.Supports.Set', self.gmcp_supports)
 
     def compression_negotiated(self, data):
         self.compression_enabled = True
 
     def gmcp(self, data):
-        with open('muddy-gmcp.log', 'a') as l:
-            l.write(repr(b''.join(data)) + '\n')
-            l.flush()
+        try:
+            package, message = parse_message(data)
+        except ValueError:
+            return
+
+        self.namespace.send('Core.gmcp_received', package=package, data=message)
+
+    def send_gmcp(self, package, data=None):
+        payload = encode_message(package, data).replace(IAC, IAC + IAC)
+        self.transport.write(IAC + SB + GMCP + payload + IAC + SE)
+        metrics.data_sent(len(payload) + 5)
 
     def dataReceived(self, data):
-        if self.compression_enabled:
-            data = self.decompress.decompress(data)
+        wire_bytes = len(data)
+        self._data_bytes = 0
 
-        Telnet.dataReceived(self, data)
+        while data:
+            if self.compression_enabled:
+                data = self._inflate(data)
+
+            # Returns what follows if compression starts within the chunk
+            data = self._receive_plain(data)
+
+        metrics.data_received(wire_bytes, self._data_bytes)
+
+        self._cancel_prompt_flush()
+        if self.prompt_flush_delay is not None and self._looks_like_prompt():
+            self._prompt_flush_call = self.clock.callLater(self.prompt_flush_delay, self._flush_prompt)
+
+        self.emit_lines()
+
+    def _inflate(self, data):
+        data = self.decompress.decompress(data)
+        if self.decompress.eof:
+            # The server ended compression, the rest is plain again
+            data += self.decompress.unused_data
+            self.decompress = zlib.decompressobj()
+            self.compression_enabled = False
+
+        return data
+
+    def _receive_plain(self, data):
+        rest = self._frame(data)
+        plain = data if rest is None else data[:len(data) - len(rest)]
+
+        self._data_bytes += len(plain)
+        if self.recorder:
+            self.recorder.record(plain)
+
+        return rest
+
+    def _frame(self, data):
+        if self._carry:
+            data = self._carry + data
+            self._carry = b''
+
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+
+        while pos < end:
+            iac = data.find(IAC, pos)
+            if iac == -1:
+                self.applicationDataReceived(view[pos:])
+                return None
+
+            if iac > pos:
+                self.applicationDataReceived(view[pos:iac])
+
+            if iac + 1 == end:
+                break
+            command = data[iac + 1]
+
+            if command == IAC[0]:
+                self.applicationDataReceived(IAC)
+                pos = iac + 2
+            elif command in OPTION_COMMANDS:
+                if iac + 2 == end:
+                    break
+                self.commandReceived(data[iac + 1:iac + 2], data[iac + 2:iac + 3])
+                pos = iac + 3
+            elif command == SB[0]:
+                se = self._find_subnegotiation_end(data, iac + 2)
+                if se == -1:
+                    break
+                pos = se + 2
+
+                payload = data[iac + 2:se]
+                if IAC + IAC in payload:
+                    payload = payload.replace(IAC + IAC, IAC)
+
+                compressed = self.compression_enabled
+                self._subnegotiation(payload[:1], payload[1:])
+                if self.compression_enabled and not compressed:
+                    return data[pos:]
+            else:
+                self.commandReceived(data[iac + 1:iac + 2], None)
+                pos = iac + 2
+        else:
+            return None
+
+        self._carry = data[iac:]
+        return None
+
+    @staticmethod
+    def _find_subnegotiation_end(data, start):
+        se = data.find(IAC_SE, start)
+        while se != -1:
+            # IAC IAC SE is an escaped 0xFF followed by a plain 0xF0
+            escapes = 0
+            while se - escapes - 1 >= start and data[se - escapes - 1] == IAC[0]:
+                escapes += 1
+            if escapes % 2 == 0:
+                return se
+            se = data.find(IAC_SE, se + 1)
+
+        return -1
+
+    def _subnegotiation(self, option, payload):
+        handler = self.negotiationMap.get(option)
+        if handler is None:
+            self.unhandledSubnegotiation(option, payload)
+        else:
+            handler(payload)
 
     def applicationDataReceived(self, data):
-        data = data.decode()
-        lines = [line.strip('\r') for line in data.split('\n')]
-        pub.sendMessage('Core.telnet_received', text=lines)
+        self.pending_lines.extend(self.line_assembler.feed(data))
+
+    def prompt_received(self):
+        self.pending_lines.extend(self.line_assembler.flush())
+
+    def emit_lines(self):
+        if not self.pending_lines:
+            return
+
+        lines = self.pending_lines
+        self.pending_lines = []
+        self.namespace.send('Core.telnet_received', text=lines)
+
+    def _looks_like_prompt(self):
+        # Anything else is more likely a line split by a slow link, which
+        # would be cut in two and missed by triggers if flushed
+        assembler = self.line_assembler
+        return assembler.has_partial and self.prompt_rx.search(ansi.strip(assembler.partial)) is not None
+
+    def _flush_prompt(self):
+        self._prompt_flush_call = None
+        self.pending_lines.extend(self.line_assembler.deliver_partial())
+        self.emit_lines()
+
+    def _cancel_prompt_flush(self):
+        if self._prompt_flush_call is not None:
+            if self._prompt_flush_call.active():
+                self._prompt_flush_call.cancel()
+            self._prompt_flush_call = None
 
     def sendData(self, data):
-        data += '\n'
-        self.transport.write(data.encode('ascii'))
+        self.send_lines([data])
+
+    def send_lines(self, lines):
+        data = ''.join(line + '\n' for line in lines).encode(self.encoding, 'replace')
+        data = data.replace(IAC, IAC + IAC)
+        self.transport.write(data)
+        metrics.data_sent(len(data))
 
     def connectionLost(self, reason):
-        pub.sendMessage('Core.telnet_received', text=['Connection lost: ' + str(reason)])
+        self.connected = 0
+        self._cancel_prompt_flush()
+        self.prompt_received()
+        self.pending_lines.append('Connection lost: ' + str(reason))
+        self.emit_lines()
 
 
 class MudClientFactory(ClientFactory):
-    def __init__(self, conn_built_handler):
+    def __init__(self, conn_built_handler, namespace=DEFAULT_NAMESPACE, encoding='utf-8',
+                 prompt_flush_delay=PROMPT_FLUSH_DELAY, prompt_rx=PROMPT_RX):
         self.conn_built_handler = conn_built_handler
+        self.namespace = namespace
+        self.encoding = encoding
+        self.prompt_flush_delay = prompt_flush_delay
+        self.prompt_rx = prompt_rx
 
     def buildProtocol(self, addr):
-        proto = MudProtocol()
+        proto = MudProtocol(self.encoding, self.prompt_flush_delay, self.prompt_rx)
+        proto.namespace = self.namespace
         self.conn_built_handler(proto)
 
         return proto
 
 
 class ConnectionKeeper:
-    def __init__(self):
+    """
+    Owns the connection and the queue of commands going out on it.
+    Telnet.send_data sends a line (or a list of them) as it is;
+    Telnet.send_commands first splits on ';' and expands speedwalks.
+    """
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, rate=None, burst=None, clock=reactor):
         self.connection = None
-        pub.subscribe(self.send_data, 'Telnet.send_data')
+        self.commands = CommandQueue(self._write, rate, burst, clock=clock)
+        namespace.subscribe(self.send_data, 'Telnet.send_data')
+        namespace.subscribe(self.send_commands, 'Telnet.send_commands')
+        namespace.subscribe(self.cancel_commands, 'Telnet.cancel_commands')
+        namespace.subscribe(self.send_gmcp, 'Telnet.send_gmcp')
     
     def register(self, proto):
         self.connection = proto
     
     def disconnect(self):
+        self.commands.cancel()
         if self.connection:
             self.connection.transport.loseConnection()
     
     def send_data(self, data):
         if self.connection:
-            self.connection.sendData(data)
\ No newline at end of file
+            self.commands.send([data] if isinstance(data, str) else data)
+
+    def send_commands(self, text):
+        if self.connection:
+            self.commands.send(expand_commands(text))
+
+    def cancel_commands(self):
+        return self.commands.cancel()
+
+    def _write(self, lines):
+        if self.connection and self.connection.connected:
+            self.connection.send_lines(lines)
+
+    def send_gmcp(self, package, data=None):
+        if self.connection:
+            self.connection.send_gmcp(package, data)
@@ -0,0 +1,150 @@
+import re
+
+
+# Patterns referring to groups by number or name cannot be fused into one
+# alternation, since group numbering changes once they are combined
+BACKREFERENCE_RX = re.compile(r'\\[1-9]|\(\?P=')
+
+SCOPED_FLAGS = (
+    (re.IGNORECASE, 'i'),
+    (re.MULTILINE, 'm'),
+    (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'),
+)
+
+
+class Trigger:
+    def __init__(self, seq, handler, pattern=None, prefix=None, flags=0):
+        if pattern is None and prefix is None:
+            raise ValueError('Trigger needs a pattern, a prefix or both')
+
+        if type(prefix) == str:
+            prefix = (prefix,)
+
+        self.seq = seq
+        self.handler = handler
+        self.prefixes = tuple(prefix) if prefix else ()
+
+        if pattern is None:
+            self.regex = re.compile('|'.join(re.escape(p) for p in self.prefixes))
+            self.matcher = self.regex.match
+        else:
+            self.regex = pattern if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)
+            self.matcher = self.regex.search
+
+    @property
+    def fusable(self):
+        return not self.prefixes and not BACKREFERENCE_RX.search(self.regex.pattern)
+
+    def scoped_pattern(self):
+        flags = ''.join(f for flag, f in SCOPED_FLAGS if self.regex.flags & flag)
+        if flags:
+            return f'(?{flags}:{self.regex.pattern})'
+        else:
+            return f'(?:{self.regex.pattern})'
+
+
+class TriggerDispatcher:
+    """
+    Decides which handlers a line of incoming text should be offered to.
+
+    Prefix triggers are looked up in a dictionary keyed by the literal line
+    prefix, regex triggers are fused into one alternation that is scanned
+    once per line and only on a hit are the individual patterns consulted.
+    Plain handlers receive every line. Handlers are returned in the order
+    they were registered in.
+    """
+
+    def __init__(self):
+        self.triggers = []
+        self.catch_all = []
+        self._compiled = False
+
+        self._prefix_index = {}
+        self._prefix_lengths = []
+        self._fused = None
+        self._fused_triggers = []
+        self._unfused_triggers = []
+
+    def add_trigger(self, seq, handler, pattern=None, prefix=None, flags=0):
+        self.triggers.append(Trigger(seq, handler, pattern, prefix, flags))
+        self._compiled = False
+
+    def add_handler(self, seq, handler):
+        self.catch_all.append((seq, handler))
+        self.catch_all.sort(key=lambda entry: entry[0])
+        self._compiled = False
+
+    def compile(self):
+        self._prefix_index = {}
+        self._fused_triggers = []
+        self._unfused_triggers = []
+
+        for trigger in sorted(self.triggers, key=lambda t: t.seq):
+            if trigger.prefixes:
+                for prefix in trigger.prefixes:
+                    self._prefix_index.setdefault(prefix, []).append(trigger)
+            elif trigger.fusable and self._compiles(trigger.scoped_pattern()):
+                self._fused_triggers.append(trigger)
+            else:
+                self._unfused_triggers.append(trigger)
+
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefix_index})
+
+        if self._fused_triggers:
+            self._fused = re.compile('|'.join(t.scoped_pattern() for t in self._fused_triggers))
+        else:
+            self._fused = None
+
+        self._compiled = True
+
+    def match(self, line):
+        if not self._compiled:
+            self.compile()
+
+        hits = []
+        matched = set()
+
+        for length in self._prefix_lengths:
+            bucket = self._prefix_index.get(line[:length])
+            if bucket:
+                for trigger in bucket:
+                    if trigger.seq in matched:
+                        continue
+                    m = trigger.matcher(line)
+                    if m:
+                        matched.add(trigger.seq)
+                        hits.append((trigger.seq, trigger.handler, (line, m)))
+
+        if self._fused is not None and self._fused.search(line):
+            for trigger in self._fused_triggers:
+                if trigger.seq in matched:
+                    continue
+                m = trigger.matcher(line)
+                if m:
+                    matched.add(trigger.seq)
+                    hits.append((trigger.seq, trigger.handler, (line, m)))
+
+        for trigger in self._unfused_triggers:
+            if trigger.seq in matched:
+                continue
+            m = trigger.matcher(line)
+            if m:
+                matched.add(trigger.seq)
+                hits.append((trigger.seq, trigger.handler, (line, m)))
+
+        if not hits:
+            return [(handler, (line,)) for seq, handler in self.catch_all]
+
+        hits.extend((seq, handler, (line,)) for seq, handler in self.catch_all)
+        hits.sort(key=lambda hit: hit[0])
+
+        return [(handler, args) for seq, handler, args in hits]
+
+    @staticmethod
+    def _compiles(pattern):
+        try:
+            re.compile(pattern)
+            return True
+        except re.error:
+            return False
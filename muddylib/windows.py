@@ -1,13 +1,107 @@
-import re
+import collections
 import curses
 import curses.ascii as asc
+import re
 
 from pubsub import pub
 
+import muddylib.ansi as ansi
+from muddylib.archive import DEFAULT_RESTORE_LINES
+from muddylib.bus import DEFAULT_NAMESPACE
 import muddylib.colors as clr
+from muddylib.scrollback import ScrollbackBuffer, DEFAULT_MAX_LINES
+from muddylib.search import ScrollbackSearch
+from muddylib.wrap import WrapIndex, REINDEX_LINES
+
+
+# Widths whose wrapped rows are kept, for resizing back and forth
+WRAP_CACHE_WIDTHS = 4
+
+
+class ColorPalette:
+    """
+    Translates ansi styles into curses attributes, allocating color pairs
+    lazily as new foreground/background combinations show up.
+    """
+
+    def __init__(self):
+        self._attrs = {}
+        self._pairs = {}
+        self._default_colors = False
+        self.headless = False
+
+    def init_headless(self):
+        """Passes styles through untouched, for rendering without a terminal."""
+        self.headless = True
+        self._attrs = {}
+
+    def init(self):
+        curses.start_color()
+        try:
+            curses.use_default_colors()
+            self._default_colors = True
+        except curses.error:
+            self._default_colors = False
+
+        self._attrs = {}
+        self._pairs = {}
+
+    def attr(self, style):
+        attr = self._attrs.get(style)
+        if attr is None:
+            attr = self._attrs[style] = style if self.headless else self._compute_attr(style)
+
+        return attr
+
+    def _compute_attr(self, style):
+        fg = ansi.fg_of(style)
+        bg = ansi.bg_of(style)
+        attr = 0
+
+        if style & ansi.BOLD:
+            if 0 <= fg < 8:
+                fg += 8
+            else:
+                attr |= curses.A_BOLD
+        if style & ansi.UNDERLINE:
+            attr |= curses.A_UNDERLINE
+        if style & ansi.REVERSE:
+            attr |= curses.A_REVERSE
+
+        if fg >= curses.COLORS:
+            if fg < 16:
+                attr |= curses.A_BOLD
+            fg = ansi.downsample(fg, curses.COLORS)
+        bg = ansi.downsample(bg, curses.COLORS)
+
+        if fg == -1 and bg == -1:
+            return attr
+
+        return attr | curses.color_pair(self._pair(fg, bg))
+
+    def _pair(self, fg, bg):
+        if not self._default_colors:
+            fg = curses.COLOR_WHITE if fg == -1 else fg
+            bg = curses.COLOR_BLACK if bg == -1 else bg
+
+        pair = self._pairs.get((fg, bg))
+        if pair is None:
+            pair = len(self._pairs) + 1
+            if pair >= curses.COLOR_PAIRS:
+                return 0
+
+            curses.init_pair(pair, fg, bg)
+            self._pairs[(fg, bg)] = pair
+
+        return pair
+
+
+palette = ColorPalette()
 
 
 class LayoutElement(object):
+    namespace = DEFAULT_NAMESPACE
+
     def __init__(self):
         self._lines = 1
         self._columns = 1
@@ -36,15 +130,31 @@ class LayoutElement(object):
         self._x = x
         self._y = y
 
+    def layout(self, lines, columns, y, x):
+        """Geometry of every window under this element, as (window, lines, columns, y, x), without applying it."""
+        raise NotImplementedError('Call of layout() in base abstract class')
+
     def init_from_config(self, config):
         raise NotImplementedError('Call of init_from_config() in base abstract class')
 
 
 class Window(LayoutElement):
+    # Replaced by the headless stand-in when replaying without a terminal
+    window_factory = staticmethod(curses.newwin)
+
+    # Cleared when nothing will ever be shown, e.g. in the daemon: windows
+    # then only keep their contents and feed the mirror
+    painting = True
+
     def __init__(self):
         super(Window, self).__init__()
         self._name = None
-        self._window = curses.newwin(1, 1, 1, 1)
+        self._window = self.window_factory(1, 1, 1, 1)
+        self.render_scheduler = None
+
+        # Called with (window, method, lines of runs) on every content
+        # change; the daemon uses it to stream to attached frontends
+        self.mirror = None
 
     @property
     def name(self):
@@ -56,9 +166,12 @@ class Window(LayoutElement):
 
     def init_from_config(self, config):
         self._name = config['name']
-        pub.subscribe(self.message_handler, self.name)
+        self.namespace.subscribe(self.message_handler, self.name)
 
         return [self]
+
+    def layout(self, lines, columns, y, x):
+        return [(self, lines, columns, y, x)]
     
     def resize(self, lines, columns, y, x):
         super(Window, self).resize(lines, columns, y, x)
@@ -70,86 +183,258 @@ class Window(LayoutElement):
     def redraw(self):
         pass
 
+    def render(self):
+        pass
+
+    def invalidate(self):
+        if not self.painting:
+            return
+
+        if self.render_scheduler:
+            self.render_scheduler.mark_dirty(self)
+        else:
+            self.render()
+            self.window.refresh()
+
     def put_text(self, y, x, text):
+        self.put_runs(y, x, ansi.parse(text))
+
+    def put_runs(self, y, x, runs):
+        if not self.painting:
+            return
+
         try:
             self.window.move(y ,x)
         except:
             return
 
-        pieces = re.split('\x1b\\[(.*?)m', text)
-        color_piece = False
-        active_pair = None
-        for piece in pieces:
-            if color_piece:
-                if piece == '0':
-                    active_pair = None
-                else:
-                    color_num = 0
-                    colors = [int(c) for c in piece.split(';')]
-                    for color in colors:
-                        if color == 1:  # bold/bright
-                            color_num += 8
-                        elif 30 <= color <= 37:  # standard 8 colors
-                            color_num += color - 30
-                    active_pair = curses.color_pair(color_num+1)
-            else:
-                try:
-                    if active_pair:
-                        self.window.addstr(piece, active_pair)
-                    else:
-                        self.window.addstr(piece)
-                except:
-                    # curses workaround
-                    pass
-
-            color_piece = not color_piece
+        for piece, style in runs:
+            try:
+                self.window.addstr(piece, palette.attr(style))
+            except:
+                # curses workaround
+                pass
 
     def message_handler(self, topic=pub.AUTO_TOPIC, **kwargs):
         topic = topic.getName()
-        if not '.' in topic:
+        own_topic = self.namespace.topic(self.name)
+        if topic == own_topic:
             return
         
-        component_name, method_name = topic.split('.', 1)
+        method_name = topic[len(own_topic) + 1:]
         if hasattr(self, method_name):
             getattr(self, method_name)(**kwargs)
 
 
 class BufferedTextWindow(Window):
+    """
+    Scrollback view that soft-wraps long lines. Scrolling counts display
+    rows; the position is kept as the (line, row within the line) shown at
+    the bottom, or None while following the newest line, so it survives
+    resizes and new lines coming in.
+    """
+
     def __init__(self):
         super(BufferedTextWindow, self).__init__()
-        self.window.scrollok(True)
-        self.buffer = []
-        self.buffer_pos = 0
+        # Rows are written up to the last column, scrolling is explicit
+        self.window.scrollok(False)
+        self.buffer = ScrollbackBuffer()
+        self.view = None
+        self._wraps = collections.OrderedDict()
+        self._painted = None
+        self._painted_end = None
+        self._search = None
+
+    def init_from_config(self, config):
+        scrollback = config.get('scrollback', {})
+        self.buffer = ScrollbackBuffer(
+            max_lines=scrollback.get('max_lines', DEFAULT_MAX_LINES),
+            max_bytes=scrollback.get('max_bytes'))
+        self._wraps.clear()
+
+        return super(BufferedTextWindow, self).init_from_config(config)
+
+    def attach_archive(self, archive, restore_lines=DEFAULT_RESTORE_LINES):
+        """Keeps the whole history in archive, restoring its newest lines; scrolling goes on into it."""
+        if self.buffer.max_lines is not None:
+            restore_lines = min(restore_lines, self.buffer.max_lines)
+        self.buffer.attach_archive(archive, restore_lines)
+
+        self.view = None
+        self._wraps.clear()
+        self.redraw()
 
     def add_text(self, text):
-        if type(text) == list:
-            for chunk in text:
-                self.add_text(chunk)
-            return
-            
-        self.buffer.append(text)
-        if self.buffer_pos == 0:
-            self.window.scroll(1)
-            y, x = self.window.getmaxyx()
-            self.put_text(y-1, 0, text)
-            self.window.refresh()
-        else:
-            self.buffer_pos += 1
+        if type(text) == str:
+            text = [text]
+
+        self.add_runs([ansi.parse(chunk) for chunk in text])
+
+    def add_runs(self, lines):
+        for runs in lines:
+            self.buffer.append(runs)
+
+        if self.view is None:
+            self.invalidate()
+
+        if self._search:
+            self._search.lines_appended()
+
+        if self.mirror:
+            self.mirror(self, 'add_runs', lines)
 
     def redraw(self):
+        self._paint_view()
+        self.invalidate()
+
+    def render(self):
+        if self.view is not None or self._painted_end is None:
+            return
+
+        y, x = self.window.getmaxyx()
+        wraps = self._wrap_index()
+        pending = wraps.end_row - self._painted_end
+        if not pending:
+            return
+
+        if pending >= y or wraps is not self._painted:
+            self._paint_view()
+            return
+
+        # Scroll once for the whole batch, then paint only the new rows
+        self.window.scrollok(True)
+        self.window.scroll(pending)
+        self.window.scrollok(False)
+        self._paint_rows(wraps, self._painted_end, wraps.end_row, y - pending)
+        self._painted_end = wraps.end_row
+
+    def _paint_view(self):
+        y, x = self.window.getmaxyx()
+        wraps = self._wrap_index()
+        bottom = self._bottom_row(wraps)
+
+        self.window.erase()
+        self._paint_rows(wraps, bottom - y + 1, bottom + 1, 0)
+        self._painted = wraps
+        self._painted_end = wraps.end_row if self.view is None else None
+
+    def _paint_rows(self, wraps, start, end, y):
+        """Paints the display rows start to end, the first one on window row y."""
+        wraps.cover(start)
+        row = max(start, wraps.top_row)
+        while row < end:
+            line_number, offset = wraps.line_at(row)
+            runs = self._line_runs(line_number)
+            for segment_start, segment_end in wraps.segments(line_number)[offset:]:
+                if row >= end:
+                    break
+                self.put_runs(y + row - start, 0, ansi.slice_runs(runs, segment_start, segment_end))
+                row += 1
+
+    def _line_runs(self, line_number):
+        runs = self.buffer.line(line_number)
+        if self._search:
+            spans = self._search.spans(self.buffer.line_text(line_number))
+            if spans:
+                runs = ansi.highlight(runs, spans)
+
+        return runs
+
+    def _wrap_index(self):
+        """The WrapIndex for the current width, caught up with the buffer while following it."""
         y, x = self.window.getmaxyx()
+        wraps = self._wraps.get(x)
+        if wraps is None or wraps.last < self.buffer.oldest_line_number or \
+                self.view is None and self.buffer.appended - wraps.last > REINDEX_LINES:
+            # Start from what is in view, the rest is covered on demand
+            wraps = self._wraps[x] = WrapIndex(self.buffer, x, self.view and max(self.view[0], self.buffer.oldest_line_number))
+            if len(self._wraps) > WRAP_CACHE_WIDTHS:
+                self._wraps.popitem(last=False)
+        self._wraps.move_to_end(x)
+
+        if self.view is None:
+            wraps.extend()
+        return wraps
+
+    def _bottom_row(self, wraps):
+        """Display row on the last line of the window, for the current view."""
+        if self.view is None:
+            return wraps.end_row - 1
+
+        line_number, offset = self.view
+        line_number = max(line_number, self.buffer.oldest_line_number)
+        wraps.cover_line(line_number)
+
+        return self._scroll_to(wraps, wraps.row_of(line_number) + min(offset, wraps.row_count(line_number) - 1))
+
+    def _scroll_to(self, wraps, row):
+        """Sets the view to have row at the bottom, kept within the scrollback."""
+        y, x = self.window.getmaxyx()
+        wraps.cover(row - y + 1)
+        row = max(row, wraps.top_row + y - 1)
+
+        wraps.extend(row + 1)
+        if row >= wraps.end_row - 1:
+            self.view = None
+            wraps.extend()
+            return wraps.end_row - 1
+
+        self.view = wraps.line_at(row)
+        return row
 
-        self.window.clear()
-        last_row = len(self.buffer) - self.buffer_pos - 1
-        first_row = last_row - y + 1
-        for l in range(last_row - first_row + 1):
-            if first_row+l >= 0:
-                self.window.scroll(1)
-                self.put_text(y-1, 0, self.buffer[first_row+l])
-        self.window.refresh()
+    def tail(self, count):
+        return [self.buffer[i] for i in range(max(len(self.buffer) - count, 0), len(self.buffer))]
 
     def scroll(self, num_rows):
-        self.buffer_pos = max(self.buffer_pos - num_rows, 0)
+        wraps = self._wrap_index()
+        self._scroll_to(wraps, self._bottom_row(wraps) + num_rows)
+        self.redraw()
+
+    def search(self, pattern, literal=False):
+        if self._search:
+            self._search.cancel()
+            self._search = None
+
+        if pattern:
+            clock = self.render_scheduler.clock if self.render_scheduler else None
+            try:
+                self._search = ScrollbackSearch(self.buffer, pattern, literal, clock, self._search_updated)
+            except re.error as e:
+                self.namespace.send('InputWindow.show_status', text=f'Bad search pattern: {e}')
+            else:
+                self._search.start()
+
+        self.redraw()
+
+    def search_next(self, direction):
+        if not self._search:
+            return
+
+        y, x = self.window.getmaxyx()
+        wraps = self._wrap_index()
+        center, offset = wraps.line_at(max(self._bottom_row(wraps) - y // 2, wraps.top_row))
+        line = self._search.step(direction, center)
+        if line is not None:
+            self._show_line(line)
+        self._report_search()
+
+    def _search_updated(self, search):
+        # Jump to the newest match as soon as the first chunk turns one up
+        if search.current is None and search.matches and self.view is None:
+            self.search_next(-1)
+        else:
+            self._report_search()
+            self.redraw()
+
+    def _report_search(self):
+        self.namespace.send('InputWindow.show_status', text=self._search.status())
+
+    def _show_line(self, line_number):
+        y, x = self.window.getmaxyx()
+        wraps = self._wrap_index()
+        line_number = max(line_number, self.buffer.oldest_line_number)
+        wraps.cover_line(line_number)
+        self._scroll_to(wraps, wraps.row_of(line_number) + y // 2)
         self.redraw()
 
 
@@ -160,17 +445,51 @@ class StaticWindow(Window):
         self.buffer = []
 
     def redraw(self):
-        self.window.clear()
-        for l, line in enumerate(self.buffer):
-            self.put_text(l, 0, line)
-        self.window.refresh()
+        self.window.erase()
+        for l, runs in enumerate(self.buffer):
+            self.put_runs(l, 0, runs)
+        self.invalidate()
 
     def set_text(self, text):
         if type(text) == str:
             text = [text]
 
-        self.buffer = text
-        self.redraw()
+        self.set_runs([ansi.parse(line) for line in text])
+
+    def set_runs(self, lines):
+        """Replaces the content, repainting only the rows that differ from what is shown."""
+        lines = list(lines)
+        if lines == self.buffer:
+            return
+
+        changed = [l for l in range(max(len(lines), len(self.buffer)))
+                   if l >= len(lines) or l >= len(self.buffer) or lines[l] != self.buffer[l]]
+        self.buffer = lines
+        self._repaint_rows(changed)
+
+    def set_lines(self, lines):
+        """Replaces just the given rows, passed as {row: text}, and repaints only those."""
+        for l, text in lines.items():
+            if l >= len(self.buffer):
+                self.buffer.extend([] for i in range(l + 1 - len(self.buffer)))
+            self.buffer[l] = ansi.parse(text)
+
+        self._repaint_rows(lines)
+
+    def _repaint_rows(self, rows):
+        for l in rows:
+            try:
+                self.window.move(l, 0)
+                self.window.clrtoeol()
+            except:
+                continue
+            if l < len(self.buffer):
+                self.put_runs(l, 0, self.buffer[l])
+
+        self.invalidate()
+
+        if self.mirror:
+            self.mirror(self, 'set_runs', self.buffer)
 
 
 DIRECTION_MAP = {
@@ -187,30 +506,66 @@ class InputWindow(Window):
     def __init__(self):
         super(InputWindow, self).__init__()
         self.input_buffer = ''
+        self.prompt = ''
+        self.status = ''
+        self.search_literal = None
 
     def refresh(self):
-        self.window.refresh()
+        self.invalidate()
 
     def redraw(self):
-        self.window.clear()
-        self.window.addstr(self.input_buffer)
-        self.window.refresh()
+        self.window.erase()
+        if self.prompt or self.input_buffer or not self.status:
+            self.window.addstr(self.prompt + self.input_buffer)
+        else:
+            self.put_text(0, 0, clr.colorify(self.status, clr.CYAN))
+        self.invalidate()
+
+    def start_search(self, literal=False):
+        self.search_literal = literal
+        self.prompt = 'find: ' if literal else 'search: '
+        self.redraw()
+
+    def cancel_search(self):
+        if self.search_literal is None:
+            return
+
+        self.search_literal = None
+        self.prompt = ''
+        self.input_buffer = ''
+        self.redraw()
+
+    def show_status(self, text):
+        self.status = text
+        self.redraw()
 
     def process_key(self, key):
-        if key == asc.NL:
-            pub.sendMessage('Core.user_input_received', input_text=self.input_buffer)
+        self.status = ''
+
+        if key == asc.NL and self.search_literal is not None:
+            try:
+                self.namespace.send('MainWindow.search', pattern=self.input_buffer, literal=self.search_literal)
+            finally:
+                # Leave search mode even if the search fails, or Enter would retry it forever
+                self.search_literal = None
+                self.prompt = ''
+                self.input_buffer = ''
+        elif key == asc.NL:
+            self.namespace.send('Core.user_input_received', input_text=self.input_buffer)
             self.input_buffer = ''
         elif key == curses.KEY_BACKSPACE or key == asc.DEL:
             if self.input_buffer:
                 self.input_buffer = self.input_buffer[:-1]
-        elif chr(key) in DIRECTION_MAP:
+        elif isinstance(key, str):
+            self.input_buffer += key
+        elif chr(key) in DIRECTION_MAP and self.search_literal is None:
             # TODO: This belongs as a plugin (i.e.: allow interception of user keys)
-            pub.sendMessage('Core.user_input_received', input_text=DIRECTION_MAP[chr(key)])
+            self.namespace.send('Core.user_input_received', input_text=DIRECTION_MAP[chr(key)])
             return
-        elif 0 <= key < 256:
+        elif 0 <= key < 128:
             self.input_buffer += chr(key)
         else:
-            pub.sendMessage('MainWindow.add_text', text=clr.colorify(f'Unhandled key: {key}', clr.CYAN + clr.BRIGHT))
+            self.namespace.send('MainWindow.add_text', text=clr.colorify(f'Unhandled key: {key}', clr.CYAN + clr.BRIGHT))
             self.refresh()
             return
         
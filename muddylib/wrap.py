@@ -0,0 +1,165 @@
+from array import array
+from bisect import bisect_right
+import unicodedata
+
+try:
+    from wcwidth import wcwidth
+except ImportError:
+    wcwidth = None
+
+
+# Lines appended past the end of a cached index beyond which it is
+# dropped and started over from the visible rows rather than caught up
+REINDEX_LINES = 4096
+
+# Rows of evicted lines are dropped once at least this many (and at least
+# half of the index) are dead
+TRIM_MIN_LINES = 1024
+
+
+def char_width(char):
+    """Terminal cells taken by char: 0 for combining and control characters, 2 for wide ones."""
+    if wcwidth is not None:
+        return max(wcwidth(char), 0)
+
+    if unicodedata.combining(char) or unicodedata.category(char) in ('Cc', 'Cf', 'Me', 'Mn'):
+        return 0
+    return 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+
+
+def text_width(text):
+    """(cells, simple) of a line of plain text; simple when each character takes exactly one cell."""
+    if text.isascii() and text.isprintable():
+        return len(text), True
+
+    widths = [char_width(char) for char in text]
+    return sum(widths), all(w == 1 for w in widths)
+
+
+def wrap_breaks(text, width):
+    """Offsets of the characters starting the second and following rows of text wrapped at width cells."""
+    breaks = []
+    col = 0
+    for i, char in enumerate(text):
+        w = char_width(char)
+        if col + w > width and col > 0:
+            breaks.append(i)
+            col = 0
+        col += w
+
+    return breaks
+
+
+class WrapIndex:
+    """
+    Display rows of the lines of a ScrollbackBuffer wrapped at one width.
+
+    It covers a contiguous range of absolute line numbers, starting at the
+    line in view, that only grows as far as it is looked at: backwards a
+    doubling chunk at a time, forwards up to the newest line. ``_starts`` holds the
+    cumulative row at which each covered line begins (plus the end row),
+    and rows never move as the range grows, so a scroll position is just
+    a row number. Break offsets are only kept for lines with wide or
+    zero-width characters; plain ones wrap every width characters.
+    """
+
+    def __init__(self, buffer, width, line_number=None):
+        self.buffer = buffer
+        self.width = max(width, 1)
+        self.first = self.last = buffer.appended if line_number is None else line_number
+        self._starts = array('q', [0])
+        self._breaks = {}
+
+    @property
+    def end_row(self):
+        return self._starts[-1]
+
+    @property
+    def top_row(self):
+        """First row of the oldest line still in the buffer, as far as covered."""
+        return self.row_of(max(self.first, self.buffer.oldest_line_number))
+
+    @property
+    def complete(self):
+        return self.first <= self.buffer.oldest_line_number
+
+    @property
+    def current(self):
+        return self.last >= self.buffer.appended
+
+    def row_of(self, line_number):
+        return self._starts[line_number - self.first]
+
+    def line_at(self, row):
+        """(absolute line number, row within that line) of a covered row."""
+        i = bisect_right(self._starts, row, 0, len(self._starts) - 1) - 1
+        return self.first + i, row - self._starts[i]
+
+    def extend(self, row=None):
+        """Covers the lines up to the newest one, or only until row is covered."""
+        starts = self._starts
+        while self.last < self.buffer.appended and (row is None or starts[-1] <= row):
+            starts.append(starts[-1] + self._rows(self.last))
+            self.last += 1
+        if row is None:
+            self._trim()
+
+    def cover(self, row):
+        """Extends the range back until it holds row or reaches the oldest line kept."""
+        while self.top_row > row and not self.complete:
+            self._extend_back()
+
+    def cover_line(self, line_number):
+        while self.first > line_number and not self.complete:
+            self._extend_back()
+        while self.last <= line_number and not self.current:
+            self.extend(self.end_row)
+
+    def row_count(self, line_number):
+        i = line_number - self.first
+        return self._starts[i + 1] - self._starts[i]
+
+    def segments(self, line_number):
+        """Character offsets (start, end) of each display row of a line."""
+        text_end = self._text_length(line_number)
+        breaks = self._breaks.get(line_number)
+        if breaks is None:
+            breaks = range(self.width, text_end, self.width)
+
+        bounds = [0, *breaks, text_end]
+        return list(zip(bounds, bounds[1:])) or [(0, 0)]
+
+    def _extend_back(self):
+        target = max(self.buffer.oldest_line_number, self.first - len(self._starts))
+        counts = [self._rows(line_number) for line_number in range(target, self.first)]
+
+        chunk = array('q')
+        row_start = self._starts[0] - sum(counts)
+        for count in counts:
+            chunk.append(row_start)
+            row_start += count
+
+        self._starts = chunk + self._starts
+        self.first = target
+
+    def _rows(self, line_number):
+        cells, simple = self.buffer.line_width(line_number)
+        if simple:
+            return max(-(-cells // self.width), 1)
+
+        breaks = [] if cells <= self.width else wrap_breaks(self.buffer.line_text(line_number), self.width)
+        self._breaks[line_number] = breaks
+        return len(breaks) + 1
+
+    def _text_length(self, line_number):
+        cells, simple = self.buffer.line_width(line_number)
+        return cells if simple else len(self.buffer.line_text(line_number))
+
+    def _trim(self):
+        # Let go of lines evicted from the buffer, in bulk like its arena.
+        # Archived ones are covered again from the archive when scrolled to.
+        dead = self.buffer.first_line_number - self.first
+        if dead >= TRIM_MIN_LINES and dead * 2 >= len(self._starts):
+            del self._starts[:dead]
+            self.first += dead
+            self._breaks = {n: b for n, b in self._breaks.items() if n >= self.first}
@@ -1,61 +1,188 @@
-import re
+import collections
 
-from muddylib.plugins import MuddyPlugin, IncomingTextHandler
+import muddylib.colors as clr
+from muddylib.plugins import MuddyPlugin, Trigger, GmcpHandler
+
+
+GAUGE_WIDTH = 10
+HISTORY_LENGTH = 24
+SPARK_CHARS = ' ▁▂▃▄▅▆▇█'
+
+# GMCP keys of each package, as the Stats fields they update
+GMCP_FIELDS = {
+    'char.vitals': {'hp': 'hp', 'mana': 'mp', 'moves': 'mv'},
+    'char.maxstats': {'maxhp': 'max_hp', 'maxmana': 'max_mp', 'maxmoves': 'max_mv'},
+    'char.status': {
+        'level': 'level',
+        'tnl': 'tnl',
+        'align': 'align',
+        'pos': 'position',
+        'enemy': 'enemy',
+        'enemypct': 'enemy_pct'
+    }
+}
+
+# Positions of the fields in the comma separated {stats} tag line:
+# str/base,int/base,wis/base,dex/base,con/base,luck/base,hp%,mp%,mv%,
+# hitroll,damroll,position,enemy%,hp/max,mp/max,mv/max,gold,qp,tp,align,
+# tnl,level,position number
+STATS_TAG = '{stats}'
+STATS_TAG_FIELDS = 23
+STATS_TAG_POSITION = 11
+STATS_TAG_INTS = {9: 'hit_roll', 10: 'dam_roll', 16: 'gold', 17: 'qp', 18: 'tp', 19: 'align', 20: 'tnl', 21: 'level'}
+STATS_TAG_POOLS = {13: ('hp', 'max_hp'), 14: ('mp', 'max_mp'), 15: ('mv', 'max_mv')}
+STATS_TAG_ENEMY = 12
+NO_ENEMY_PCT = 9999
+
+# (gauge row, history sparkline row, label, field, maximum field) of each pool
+POOLS = (
+    (0, 8, 'H', 'hp', 'max_hp'),
+    (1, 9, 'M', 'mp', 'max_mp'),
+    (2, 10, 'V', 'mv', 'max_mv')
+)
+ENEMY_ROW = 4
+POSITION_ROW = 6
+
+
+class Stats:
+    """
+    Last known state of the character. update() returns the names of the
+    fields it changed; numeric values that don't parse are skipped.
+    """
+
+    __slots__ = (
+        'hp', 'max_hp', 'mp', 'max_mp', 'mv', 'max_mv',
+        'level', 'tnl', 'align', 'gold', 'qp', 'tp', 'hit_roll', 'dam_roll',
+        'position', 'enemy', 'enemy_pct'
+    )
+    text_fields = ('position', 'enemy')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, '' if name in self.text_fields else 0)
+        self.enemy_pct = None
+
+    def update(self, fields):
+        changed = []
+        for name, value in fields.items():
+            if value is not None and name not in self.text_fields:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    continue
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed.append(name)
+        return changed
+
+
+def parse_stats_tag(line):
+    """Fields of a {stats} tag line, or None if the line isn't one."""
+    parts = line[len(STATS_TAG):].split(',')
+    if len(parts) != STATS_TAG_FIELDS:
+        return None
+
+    try:
+        fields = {name: int(parts[i]) for i, name in STATS_TAG_INTS.items()}
+        for i, (name, max_name) in STATS_TAG_POOLS.items():
+            current, maximum = parts[i].split('/')
+            fields[name] = int(current)
+            fields[max_name] = int(maximum)
+        enemy_pct = int(parts[STATS_TAG_ENEMY])
+    except ValueError:
+        return None
+
+    fields['position'] = parts[STATS_TAG_POSITION]
+    fields['enemy_pct'] = None if enemy_pct >= NO_ENEMY_PCT else enemy_pct
+    return fields
+
+
+def percent(value, maximum):
+    return max(0, min(100, value * 100 // maximum)) if maximum > 0 else 0
+
+
+def gauge(pct, width=GAUGE_WIDTH):
+    pct = max(0, min(100, pct))
+    filled = (pct * width + 50) // 100
+    color = clr.GREEN if pct > 50 else clr.YELLOW if pct > 25 else clr.RED
+    return clr.colorify('█' * filled, color + clr.BRIGHT) + clr.colorify('░' * (width - filled), clr.BLACK + clr.BRIGHT)
+
+
+def sparkline(values):
+    top = len(SPARK_CHARS) - 1
+    return ''.join(SPARK_CHARS[(pct * top + 50) // 100] for pct in values)
 
 
 class AardwolfStatsPlugin(MuddyPlugin):
-    stats_rx = re.compile("""^({stats})
-        (?P<i_curr_str>\\d+)/(?P<i_base_str>\\d+),
-        (?P<i_curr_int>\\d+)/(?P<i_base_int>\\d+),
-        (?P<i_curr_wis>\\d+)/(?P<i_base_wis>\\d+),
-        (?P<i_curr_dex>\\d+)/(?P<i_base_dex>\\d+),
-        (?P<i_curr_con>\\d+)/(?P<i_base_con>\\d+),
-        (?P<i_curr_luck>\\d+)/(?P<i_base_luck>\\d+),
-        (?P<i_hp_pct>\\d+),(?P<i_mp_pct>\\d+),(?P<i_mv_pct>\\d+),
-        (?P<i_hit_roll>\\d+),(?P<i_dam_roll>\\d+),
-        (?P<position>[^,]*),
-        (?P<i_enemy_pct>\\d+),
-        (?P<i_curr_hp>\\d+)/(?P<i_max_hp>\\d+),
-        (?P<i_curr_mp>\\d+)/(?P<i_max_mp>\\d+),
-        (?P<i_curr_mv>\\d+)/(?P<i_max_mv>\\d+),
-        (?P<i_gold>\\d+),
-        (?P<i_qp>\\d+),(?P<i_tp>\\d+),
-        (?P<i_align>\\d+),
-        (?P<i_tnl>\\d+),
-        (?P<i_level>\\d+),
-        (?P<i_position_num>\\d+)
-        $""", re.VERBOSE)
-    
-    @IncomingTextHandler
-    def handle(self, line):
-        stats_m = self.stats_rx.search(line)
-        if stats_m:
-            stats = StatsParser(stats_m)
-            self.invoke_method('StatsWindow', 'set_text', text=[
-                f'H: {stats.curr_hp}/{stats.max_hp}',
-                f'M: {stats.curr_mp}/{stats.max_mp}',
-                f'V: {stats.curr_mv}/{stats.max_mv}',
-                '',
-                f'E: {stats.enemy_pct}' if stats.enemy_pct < 9999 else '',
-                '',
-                stats.position
-                ])
-            return True
-
-        return False
-
-
-class StatsParser:
-    def __init__(self, match):
-        self.data = {}
-        for k, v in match.groupdict().items():
-            if k.startswith('i_'):
-                self.data[k[2:]] = int(v)
-            else:
-                self.data[k] = v
-    
-    def __getattr__(self, name):
-        if name in self.data:
-            return self.data[name]
-        else:
-            return None
+    """
+    Keeps a Stats record up to date from GMCP char.vitals, char.maxstats
+    and char.status, or from {stats} tag lines where GMCP is off, and
+    repaints only the StatsWindow rows whose text changed.
+    """
+
+    def __init__(self):
+        self.stats = Stats()
+        self.history = {field: collections.deque(maxlen=HISTORY_LENGTH) for row, history_row, label, field, max_field in POOLS}
+        self.rows = {}
+
+    @GmcpHandler('char')
+    def gmcp_char(self, package, changes, state):
+        keys = GMCP_FIELDS.get(package)
+        if keys is None or not isinstance(changes, dict):
+            return
+
+        fields = {keys[key]: value for key, value in changes.items() if key in keys}
+        if 'enemy_pct' in fields or 'enemy' in fields:
+            # Aardwolf reports 0% while there is nothing to fight
+            status = state.get('char.status', {})
+            fields['enemy_pct'] = status.get('enemypct') if status.get('enemy') else None
+        self.stats_changed(self.stats.update(fields))
+
+    @Trigger(prefix=STATS_TAG)
+    def stats_tag(self, line, match):
+        fields = parse_stats_tag(line)
+        if fields is None:
+            return False
+
+        self.stats_changed(self.stats.update(fields))
+        return True
+
+    def stats_changed(self, changed):
+        if not changed:
+            return
+
+        rows = set()
+        for row, history_row, label, field, max_field in POOLS:
+            if field in changed or max_field in changed:
+                maximum = getattr(self.stats, max_field)
+                if maximum:
+                    self.history[field].append(percent(getattr(self.stats, field), maximum))
+                rows.update((row, history_row))
+        if 'enemy_pct' in changed or 'enemy' in changed:
+            rows.add(ENEMY_ROW)
+        if 'position' in changed:
+            rows.add(POSITION_ROW)
+
+        lines = {}
+        for row in rows:
+            text = self.render_row(row)
+            if self.rows.get(row) != text:
+                self.rows[row] = lines[row] = text
+
+        if lines:
+            self.invoke_method('StatsWindow', 'set_lines', lines=lines)
+
+    def render_row(self, row):
+        stats = self.stats
+        for pool_row, history_row, label, field, max_field in POOLS:
+            if row == pool_row:
+                value, maximum = getattr(stats, field), getattr(stats, max_field)
+                return f'{label} {value:>5}/{maximum:<5} ' + gauge(percent(value, maximum))
+            if row == history_row:
+                return f'{label.lower()} ' + sparkline(self.history[field])
+
+        if row == ENEMY_ROW:
+            return '' if stats.enemy_pct is None else f'E {stats.enemy_pct:>3}%        ' + gauge(stats.enemy_pct)
+        if row == POSITION_ROW:
+            return stats.position
+        return ''
@@ -0,0 +1,143 @@
+import re
+
+import muddylib.ansi as ansi
+import muddylib.colors as clr
+from muddylib.automap import DEFAULT_DATABASE, Room, RoomGraph
+from muddylib.commands import SPEEDWALK_DIRECTIONS, make_speedwalk
+from muddylib.plugins import MuddyPlugin, GmcpHandler, InputHandler
+
+
+# Seconds new rooms wait before being committed, so that a walk through
+# many of them costs one transaction
+COMMIT_DELAY = 2.0
+
+PATH_COMMAND = '#path'
+
+EXITS_RX = re.compile(r'\[ ?Exits: ([^\]]*)\]')
+
+
+def path_commands(directions):
+    """Commands walking a path: speedwalks for the compass directions, anything else as it is."""
+    commands = []
+    walk = []
+    for direction in directions:
+        if direction in SPEEDWALK_DIRECTIONS:
+            walk.append(SPEEDWALK_DIRECTIONS[direction])
+            continue
+
+        if walk:
+            commands.append(make_speedwalk(walk))
+            walk = []
+        commands.append(direction)
+    if walk:
+        commands.append(make_speedwalk(walk))
+
+    return ';'.join(commands)
+
+
+class AutomapperPlugin(MuddyPlugin):
+    """
+    Maps rooms from GMCP room.info into a RoomGraph as they are visited.
+    '#path <room id, name or area>' walks to the nearest match. Without
+    GMCP the map frames can only tell which known room this is, by the
+    room name on their first line and the exits, not add new ones.
+    """
+
+    def __init__(self):
+        self.graph = None
+        self.current = None
+        self.gmcp_seen = False
+        self._commit_call = None
+
+    def load(self):
+        if self.graph is None:
+            self.graph = RoomGraph(self.configuration.get('database', DEFAULT_DATABASE))
+            self.graph.warm()
+        self.subscribe(self.map_frame, 'MinimapWindow.set_text')
+
+    def unload(self):
+        super().unload()
+        if self._commit_call is not None and self._commit_call.active():
+            self._commit_call.cancel()
+        self._commit_call = None
+        if self.graph is not None:
+            self.graph.close()
+            self.graph = None
+
+    def get_state(self):
+        state = super().get_state()
+        # The new instance opens its own connection
+        state.pop('graph', None)
+        state.pop('_commit_call', None)
+        return state
+
+    @GmcpHandler('room.info')
+    def room_info(self, package, changes, state):
+        info = state.get('room.info')
+        if not isinstance(info, dict) or 'num' not in info:
+            return
+
+        self.gmcp_seen = True
+        coord = info.get('coord') or {}
+        exits = {direction: int(target) for direction, target in (info.get('exits') or {}).items() if int(target) >= 0}
+        room = Room(int(info['num']), ansi.strip(info.get('name', '')), info.get('zone'), info.get('terrain'),
+                    coord.get('x'), coord.get('y'), coord.get('cont'), exits)
+
+        self.current = room.id
+        if self.graph.add_room(room) and self._commit_call is None:
+            self._commit_call = self.clock.callLater(COMMIT_DELAY, self._commit)
+
+    def map_frame(self, text):
+        if self.gmcp_seen:
+            return
+
+        lines = [ansi.strip(line).strip() for line in ([text] if isinstance(text, str) else text)]
+        names = [line for line in lines if line]
+        exits = None
+        for line in lines:
+            m = EXITS_RX.search(line)
+            if m:
+                exits = {word[0] for word in m.group(1).lower().split()}
+        if not names:
+            return
+
+        candidates = self.graph.named(names[0])
+        if exits is not None:
+            candidates = [room_id for room_id in candidates
+                          if set(self.graph.room(room_id).exits) == exits]
+        if len(candidates) == 1:
+            self.current = candidates[0]
+
+    @InputHandler
+    def path_command(self, text):
+        command, _, query = text.strip().partition(' ')
+        if command != PATH_COMMAND:
+            return False
+
+        self.walk_to(query.strip())
+        return True
+
+    def walk_to(self, query):
+        if self.current is None:
+            return self.report('Automapper: no idea where we are yet')
+
+        targets = self.graph.find(query) if query else []
+        if not targets:
+            return self.report(f'Automapper: no room known as {query!r}')
+
+        path = self.graph.shortest_path(self.current, targets)
+        if path is None:
+            return self.report(f'Automapper: no known way to {query!r}')
+
+        commands = path_commands(path)
+        self.report(f'Automapper: {len(path)} steps to {query!r}: {commands}')
+        if commands:
+            self.invoke_method('Telnet', 'send_commands', text=commands)
+
+    def report(self, text):
+        self.invoke_method('MainWindow', 'add_text', text=clr.colorify(text, clr.CYAN + clr.BRIGHT))
+
+    def _commit(self):
+        self._commit_call = None
+        if self.graph is not None:
+            self.graph.commit()
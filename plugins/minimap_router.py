@@ -1,25 +1,63 @@
-import re
+from muddylib.plugins import MuddyPlugin, IncomingTextHandler, Trigger
 
-from muddylib.plugins import MuddyPlugin, IncomingTextHandler
+
+# Seconds between two map updates at the most; frames arriving faster,
+# e.g. while speedwalking, only show the latest one
+DEFAULT_MIN_INTERVAL = 0.1
 
 
 class MinimapRouterPlugin(MuddyPlugin):
     def __init__(self):
         self.buffer = []
         self.collecting_map = False
+        self.frame = []
+        self.shown = None
+        self.shown_at = None
+        self._show_call = None
+
+    @Trigger(r'^<MAPSTART>$', prefix='<MAPSTART>')
+    def map_start(self, line, match):
+        self.buffer = []
+        self.collecting_map = True
+        return True
+
+    @Trigger(r'^(\x1b\[0;37m)?<MAPEND>$', prefix=('<MAPEND>', '\x1b[0;37m<MAPEND>'))
+    def map_end(self, line, match):
+        self.collecting_map = False
+        self.frame = self.buffer
+        if self._show_call is None:
+            wait = 0
+            if self.shown_at is not None:
+                interval = self.configuration.get('min_interval', DEFAULT_MIN_INTERVAL)
+                wait = self.shown_at + interval - self.clock.seconds()
+            if wait > 0:
+                self._show_call = self.clock.callLater(wait, self.show_map)
+            else:
+                self.show_map()
+        return True
 
     @IncomingTextHandler
-    def handle(self, line):
-        if re.search(r'^<MAPSTART>$', line):
-            self.buffer = []
-            self.collecting_map = True
-            return True
-        elif re.search(r'^(\x1b\[0;37m)?<MAPEND>$', line):
-            self.collecting_map = False
-            self.invoke_method('MinimapWindow', 'set_text', text=self.buffer)
-            return True
-        elif self.collecting_map:
+    def collect(self, line):
+        if self.collecting_map:
             self.buffer.append(line)
             return True
         else:
             return False
+
+    def show_map(self):
+        self._show_call = None
+        self.shown_at = self.clock.seconds()
+        if self.frame != self.shown:
+            self.shown = self.frame
+            self.invoke_method('MinimapWindow', 'set_text', text=self.frame)
+
+    def get_state(self):
+        state = super().get_state()
+        state.pop('_show_call', None)
+        return state
+
+    def unload(self):
+        if self._show_call is not None and self._show_call.active():
+            self._show_call.cancel()
+        self._show_call = None
+        super().unload()